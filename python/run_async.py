@@ -0,0 +1,53 @@
+# Serve Search Hub from gevent instead of a thread per request.
+#
+# Python 2 has no asyncio, so the cooperative mode is built on gevent: once the standard library is
+# monkey patched, every blocking call to Fusion made by requests (the /api proxy, the /snowplow signals,
+# the backend) yields to the event loop instead of holding a thread.  One worker process (one event loop)
+# is forked per core, all accepting on the same socket.
+from gevent import monkey
+monkey.patch_all()
+
+import multiprocessing
+import os
+import signal
+import sys
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from server import app
+from server.proxy import parse_host_port
+
+
+def serve(server):
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    host, port = parse_host_port(app.config.get("ASYNC_LISTEN", "0.0.0.0:5000"))
+    workers = app.config.get("ASYNC_WORKERS") or multiprocessing.cpu_count()
+    max_connections = app.config.get("ASYNC_MAX_CONNECTIONS", 1000)
+
+    server = WSGIServer((host, port), app, spawn=Pool(max_connections))
+    # bind before forking so that every worker accepts on the same socket.  The backend's sessions were made on
+    # import, in this process, and drop the connections they inherit on their first request in each worker
+    server.init_socket()
+
+    children = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            serve(server)
+            sys.exit(0)
+        children.append(pid)
+
+    print "Serving on {0}:{1} with {2} workers".format(host, port, workers)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
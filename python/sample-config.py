@@ -12,6 +12,11 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 # The backend for the lucidfind application
 #BACKEND = "server.backends.mock.MockBackend"
 BACKEND = "server.backends.fusion.FusionBackend"
+# FusionBackend plus *_async versions of its calls that run concurrently, on FUSION_ASYNC_MAX_CALLS workers per
+# process (greenlets under run_async.py); calls beyond FUSION_ASYNC_MAX_QUEUE waiting for a worker are refused
+#BACKEND = "server.backends.async_fusion.AsyncFusionBackend"
+FUSION_ASYNC_MAX_CALLS = 20
+FUSION_ASYNC_MAX_QUEUE = 1000
 
 # Application threads. A common general assumption is
 # using 2 per available processor cores - to handle
@@ -37,6 +42,150 @@ FUSION_PORT = 8764
 FUSION_URL = "http://" + FUSION_HOST + ":" + str(FUSION_PORT) + "/api/"
 FUSION_COLLECTION = "lucidfind"
 
+# To spread the load over several Fusion API nodes, list their base URLs here.  The proxy and the backend
+# send each request to the healthy node with the fewest outstanding requests.  A node that fails
+# FUSION_NODE_MAX_FAILURES requests in a row is taken out of rotation until a GET of FUSION_HEALTH_PATH,
+# made every FUSION_HEALTH_INTERVAL seconds, succeeds again.
+#FUSION_NODES = ["http://fusion1:8764", "http://fusion2:8764"]
+FUSION_NODE_MAX_FAILURES = 3
+FUSION_NODE_EJECT_SECONDS = 30
+FUSION_HEALTH_PATH = "/api"
+FUSION_HEALTH_INTERVAL = 5
+FUSION_HEALTH_TIMEOUT = 2
+
+# Hedged requests (needs more than one FUSION_NODES entry): a GET under HEDGING_PREFIXES, from the proxy or the
+# backend, that has not been answered after the HEDGING_PERCENTILE latency of recent calls (once there are
+# HEDGING_MIN_SAMPLES of them, and never sooner than HEDGING_MIN_DELAY seconds) is also sent to another node, and
+# the first answer wins.  Hedges are capped at about HEDGING_MAX_RATE of all calls, with bursts of HEDGING_BURST.
+HEDGING_ENABLED = False
+HEDGING_PREFIXES = ["/api/apollo/query-pipelines/"]
+HEDGING_PERCENTILE = 95
+HEDGING_MIN_SAMPLES = 100
+HEDGING_MIN_DELAY = 0.01
+HEDGING_MAX_RATE = 0.05
+HEDGING_BURST = 10
+
+# Connection pool used by the /api proxy.  Each worker process keeps up to FUSION_POOL_SIZE
+# warm connections to Fusion.  Timeouts are in seconds.
+FUSION_POOL_SIZE = 10
+FUSION_KEEP_ALIVE = True
+FUSION_CONNECT_TIMEOUT = 3.05
+FUSION_READ_TIMEOUT = 30
+
+# Cache the results of FusionBackend.find_documents until the lucidfind collection changes.  Changes are
+# detected by polling, every FUSION_RESULT_CACHE_POLL_INTERVAL seconds, either the collection's highest document
+# _version_ and document count ("index") or which datasource jobs last started and ended ("jobs"); results are
+# never served more than one poll after a change.
+FUSION_RESULT_CACHE_ENABLED = False
+FUSION_RESULT_CACHE_INVALIDATION = "index"
+FUSION_RESULT_CACHE_POLL_INTERVAL = 10
+FUSION_RESULT_CACHE_SIZE = 1000
+
+# Ask for facet counts with their own rows=0 query, and cache them per query and filters (along with the
+# results cache above, and invalidated the same way), so paging through a query only fetches the documents.
+FUSION_FACET_CACHE_ENABLED = False
+
+# Federated search: have find_documents query each of these collections at the same time and merge the hits by
+# score and the facet counts by adding them up.  "url" (with "username" and "password", defaulting to the app
+# user's) points a target at another Fusion cluster; without it the target is on FUSION_URL.  Targets that don't
+# answer within their "timeout" (FUSION_FEDERATED_TIMEOUT by default) seconds are left out and the results are
+# flagged as partial (and not cached).  The targets are searched by FUSION_FEDERATED_MAX_CALLS workers per process;
+# searches beyond FUSION_FEDERATED_MAX_QUEUE waiting for a worker count as failed.  Hits are merged by their score
+# relative to the top hit of their own target.
+FUSION_FEDERATED_TARGETS = [
+  #{"collection": "lucidfind", "pipeline": "default"},
+  #{"name": "archive", "url": "http://archive-fusion:8764/api/", "collection": "lucidfind_archive", "timeout": 2}
+]
+FUSION_FEDERATED_TIMEOUT = 5
+FUSION_FEDERATED_MAX_CALLS = 20
+FUSION_FEDERATED_MAX_QUEUE = 100
+
+# JSON library for decoding Fusion responses and encoding what we send and serve: "auto" picks ujson, then
+# simplejson, then the standard library json, whichever is installed first.  If ijson 3.1+ with its C (yajl2)
+# backend is installed, search responses are decoded as a stream and only their "response" and "facet_counts"
+# sections are built into Python objects; set JSON_STREAMING_DECODE = False to always decode all of them.
+JSON_CODEC = "auto"
+JSON_STREAMING_DECODE = True
+
+# How many ids FusionBackend.get_documents looks up per query
+FUSION_GET_DOCUMENTS_CHUNK_SIZE = 500
+
+# In-process cache of proxied GET responses.  TTLs (in seconds) are picked by the longest matching
+# path prefix; paths that match no rule use PROXY_CACHE_DEFAULT_TTL, and a TTL of 0 means "don't cache".
+# Expired entries are still served for PROXY_CACHE_STALE_SECONDS while they are refreshed in the background.
+PROXY_CACHE_ENABLED = False
+PROXY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+PROXY_CACHE_TTL_RULES = {
+  "/api/apollo/query-pipelines/": 60
+}
+PROXY_CACHE_DEFAULT_TTL = 0
+PROXY_CACHE_STALE_SECONDS = 30
+
+# Compress responses that Fusion sent uncompressed, for clients that accept gzip.  Responses from
+# Fusion that are already gzipped are passed through as-is.  Streamed responses are compressed as
+# they go, so they are never buffered; bodies shorter than PROXY_GZIP_MIN_BYTES are left alone.
+PROXY_GZIP_ENABLED = False
+PROXY_GZIP_MIN_BYTES = 1024
+PROXY_GZIP_LEVEL = 6
+
+# Give GET responses under these prefixes a strong ETag (unless Fusion sent one) and the Cache-Control
+# below, and answer repeat requests carrying a matching If-None-Match with a 304.
+PROXY_ETAG_ENABLED = False
+PROXY_ETAG_PREFIXES = ["/api/apollo/query-pipelines/"]
+PROXY_CACHE_CONTROL = "private, max-age=30"
+
+# Slim down search responses per route (longest matching prefix wins).  "fields" is an allow-list of stored
+# fields: the fl sent to Fusion is narrowed to it and anything else is dropped from the response.  "truncate"
+# caps text fields, and "highlight_chars" every highlighting snippet, to that many characters.
+PROXY_SHAPING_RULES = {
+  #"/api/apollo/query-pipelines/lucidfind-default/": {
+  #  "fields": ["id", "title", "subject", "author", "project", "project_label", "datasource_label", "url",
+  #             "publishedOnDate", "content", "body", "threadId"],
+  #  "truncate": {"content": 1000, "body": 1000},
+  #  "highlight_chars": 300
+  #}
+}
+
+# Collapse identical concurrent GETs under these prefixes into a single call to Fusion.  Requests that
+# wait longer than PROXY_COALESCE_TIMEOUT seconds, or whose leader fails, go to Fusion on their own.
+PROXY_COALESCE_ENABLED = False
+PROXY_COALESCE_PREFIXES = ["/api/apollo/query-pipelines/"]
+PROXY_COALESCE_TIMEOUT = 5.0
+
+# Circuit breakers, one per Fusion route (each of BREAKER_PREFIXES for the proxy, each search target for
+# FusionBackend.find_documents).  Calls that fail, get a 5xx or take over BREAKER_SLOW_SECONDS count as failures;
+# once BREAKER_FAILURE_RATE of the last BREAKER_WINDOW calls (and at least BREAKER_MIN_CALLS) failed, calls are
+# refused for BREAKER_OPEN_SECONDS, after which a single probe decides whether to close the circuit again.  While
+# it is open, the last good response to the same query (up to BREAKER_STALE_MAX_AGE seconds old) is served
+# instead, if BREAKER_SERVE_STALE and there is one, and otherwise the request fails right away with a 503.  Each
+# worker keeps at most BREAKER_STALE_MAX_ENTRIES of those, taking up at most BREAKER_STALE_MAX_BYTES.  The proxy
+# only keeps them for paths under BREAKER_STALE_PREFIXES, since it has to buffer those responses rather than
+# stream them.
+BREAKER_ENABLED = False
+BREAKER_PREFIXES = ["/api/apollo/query-pipelines/"]
+BREAKER_FAILURE_RATE = 0.5
+BREAKER_SLOW_SECONDS = 5.0
+BREAKER_WINDOW = 20
+BREAKER_MIN_CALLS = 10
+BREAKER_OPEN_SECONDS = 30
+BREAKER_SERVE_STALE = True
+BREAKER_STALE_PREFIXES = []
+BREAKER_STALE_MAX_ENTRIES = 1000
+BREAKER_STALE_MAX_BYTES = 64 * 1024 * 1024
+BREAKER_STALE_MAX_AGE = 3600
+
+# Admission control for calls to Fusion.  Each traffic class has its own in-flight limit and a bounded
+# queue with a deadline (in seconds); all classes share ADMISSION_MAX_IN_FLIGHT, and when a slot frees up
+# the class with the lowest priority number goes first.  Shed searches get a 503, shed typeahead requests
+# a 429 and shed signals are dropped.
+ADMISSION_ENABLED = False
+ADMISSION_MAX_IN_FLIGHT = 50
+ADMISSION_CLASSES = {
+  "search": {"priority": 0, "limit": 40, "queue_size": 100, "queue_timeout": 2.0},
+  "suggest": {"priority": 1, "limit": 10, "queue_size": 20, "queue_timeout": 0.25},
+  "signals": {"priority": 2, "limit": 5, "queue_size": 50, "queue_timeout": 0.1}
+}
+
 
 FUSION_ADMIN_USERNAME="admin"
 FUSION_ADMIN_PASSWORD="XXXXXX"
@@ -64,3 +213,72 @@ TWITTER_ACCESS_TOKEN = "YYYYYYYY"
 TWITTER_TOKEN_SECRET = "YYYYYYYYYYYYYYYYYYYYYYYYYYYYYYYY"
 
 ENABLE_SCHEDULES=False
+
+# Drop signals before they reach Fusion when the User-Agent is empty or matches SIGNAL_FILTER_BOT_PATTERNS
+# (regular expressions, case-insensitive), when the same event id (Snowplow's eid) was already seen in the last
+# SIGNAL_FILTER_DEDUPE_WINDOW to 2 * SIGNAL_FILTER_DEDUPE_WINDOW seconds, or when the client address sent more
+# than SIGNAL_FILTER_RATE_LIMIT signals in the current SIGNAL_FILTER_RATE_WINDOW seconds.  Memory use is fixed:
+# the rate counts live in a SKETCH_WIDTH x SKETCH_DEPTH count-min sketch (which can only overcount), and event
+# ids in Bloom filters sized for DEDUPE_CAPACITY ids at DEDUPE_ERROR_RATE false positives.  Behind reverse
+# proxies, set SIGNAL_FILTER_PROXY_HOPS to how many of them add themselves to X-Forwarded-For, so the client
+# address is read from there instead of all visitors sharing the proxy's; leave it at 0 when clients connect
+# directly, as X-Forwarded-For can then be forged.
+SIGNAL_FILTER_ENABLED = False
+SIGNAL_FILTER_RATE_LIMIT = 120
+SIGNAL_FILTER_RATE_WINDOW = 60
+SIGNAL_FILTER_SKETCH_WIDTH = 2048
+SIGNAL_FILTER_SKETCH_DEPTH = 4
+SIGNAL_FILTER_DEDUPE_CAPACITY = 100000
+SIGNAL_FILTER_DEDUPE_ERROR_RATE = 0.001
+SIGNAL_FILTER_DEDUPE_WINDOW = 600
+SIGNAL_FILTER_PROXY_HOPS = 1
+SIGNAL_FILTER_BOT_PATTERNS = ["bot", "crawl", "spider", "slurp", "curl", "wget", "python-requests", "headless",
+                              "phantomjs"]
+
+# Queue Snowplow signals in memory and send them to Fusion from a background thread, in batches of up to
+# SIGNAL_BATCH_SIZE or every SIGNAL_FLUSH_INTERVAL seconds, so the tracking pixel is returned right away.
+# Signals arriving while SIGNAL_QUEUE_SIZE signals are already waiting are dropped.
+SIGNAL_BATCHING_ENABLED = False
+SIGNAL_QUEUE_SIZE = 10000
+SIGNAL_BATCH_SIZE = 100
+SIGNAL_FLUSH_INTERVAL = 1.0
+
+# Combine repeated signals of the types below (same collection, type, doc id, query and project) over
+# SIGNAL_AGGREGATION_WINDOW second tumbling windows, and send one signal per key, whose count is the number of
+# signals it stands for, when the window closes.  Signals still in the open window are only held in memory.
+SIGNAL_AGGREGATION_ENABLED = False
+SIGNAL_AGGREGATION_WINDOW = 60
+SIGNAL_AGGREGATION_MAX_KEYS = 100000
+SIGNAL_AGGREGATE_TYPES = ["click", "search"]
+
+# Write signals to an append-only spool on local disk instead, and replay them to Fusion from a background
+# thread with backoff, so no signal is lost while Fusion is slow, down or restarting (this takes precedence
+# over SIGNAL_BATCHING_ENABLED).  SIGNAL_SPOOL_FSYNC is "always", "interval" (every SIGNAL_SPOOL_FSYNC_INTERVAL
+# seconds) or "never".  Each worker process keeps at most SIGNAL_SPOOL_MAX_BYTES on disk, dropping the
+# oldest unsent signals beyond that.  Signals Fusion rejects as invalid are not retried but appended to
+# dead-letters.jsonl in SIGNAL_SPOOL_DIR.
+SIGNAL_SPOOL_ENABLED = False
+SIGNAL_SPOOL_DIR = os.path.join(BASE_DIR, "signal_spool")
+SIGNAL_SPOOL_SEGMENT_BYTES = 4 * 1024 * 1024
+SIGNAL_SPOOL_MAX_BYTES = 256 * 1024 * 1024
+SIGNAL_SPOOL_FSYNC = "interval"
+SIGNAL_SPOOL_FSYNC_INTERVAL = 1.0
+SIGNAL_SPOOL_MAX_BACKOFF = 60
+
+# Load the Snowplow pixel, the rendered index.html and the client templates into memory once at startup and
+# serve them from there, with ETags and a gzipped copy, instead of reading (and rendering) them per request.
+# Changes to those files then need a restart, so leave this off while working on the UI.
+STATIC_PRELOAD_ENABLED = False
+STATIC_CACHE_CONTROL = "public, max-age=3600"
+STATIC_PIXEL_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Serve /export, which streams every document matching a query (q, source, author, project) as newline-delimited
+# JSON, paging through Fusion EXPORT_BATCH_SIZE documents at a time with cursorMark.
+EXPORT_ENABLED = False
+EXPORT_BATCH_SIZE = 500
+
+# Settings for run_async.py (requires gevent).  ASYNC_WORKERS defaults to one worker per core.  When running
+# this way, raise FUSION_POOL_SIZE so that concurrent requests are not queued behind a small connection pool.
+ASYNC_LISTEN = "0.0.0.0:5000"
+ASYNC_WORKERS = None
+ASYNC_MAX_CONNECTIONS = 1000
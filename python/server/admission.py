@@ -0,0 +1,169 @@
+import threading
+import time
+
+from server import app, stats
+from server.lazy import PerProcess
+
+
+class Overloaded(Exception):
+    "Raised when a call to Fusion is shed instead of being admitted"
+
+    def __init__(self, traffic_class, reason):
+        super(Overloaded, self).__init__("{0} shed: {1}".format(traffic_class, reason))
+        self.traffic_class = traffic_class
+        self.reason = reason
+
+
+class TrafficClass(object):
+    def __init__(self, name, priority=0, limit=10, queue_size=0, queue_timeout=0.0):
+        self.name = name
+        self.priority = priority
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self.timeouts = 0
+
+
+class AdmissionController(object):
+    """
+    Bounds how many calls to Fusion are in flight, per traffic class and overall.
+
+    A call that can't start right away waits in its class' queue until a slot frees up
+    or its deadline passes.  When a slot frees up, waiters from the class with the lowest
+    priority number go first, so interactive search keeps moving while typeahead and
+    signals back off.  When a queue is full, or a deadline passes, the call is shed with
+    an Overloaded error instead of adding to Fusion's load.
+    """
+
+    def __init__(self, max_in_flight, classes):
+        self.max_in_flight = max_in_flight
+        self.classes = dict((c.name, c) for c in classes)
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def _can_run(self, cls):
+        return cls.in_flight < cls.limit and self.in_flight < self.max_in_flight
+
+    def _is_next(self, cls):
+        for other in self.classes.values():
+            if other.priority < cls.priority and other.waiting > 0 and other.in_flight < other.limit:
+                return False
+        return True
+
+    def acquire(self, name):
+        """
+        Wait for a slot for a call in the given traffic class
+
+        :param name: the traffic class
+        :raises Overloaded: if the call was shed
+        """
+        cls = self.classes[name]
+        with self._cond:
+            if not (self._can_run(cls) and self._is_next(cls)):
+                if cls.waiting >= cls.queue_size:
+                    cls.shed += 1
+                    raise Overloaded(name, "queue full")
+                deadline = time.time() + cls.queue_timeout
+                cls.waiting += 1
+                try:
+                    while not (self._can_run(cls) and self._is_next(cls)):
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            cls.shed += 1
+                            cls.timeouts += 1
+                            raise Overloaded(name, "queue timeout")
+                        self._cond.wait(remaining)
+                finally:
+                    cls.waiting -= 1
+                    if cls.waiting == 0:
+                        # lower priority waiters held back by this class' queue (e.g. when the last waiter
+                        # just timed out) may be next now
+                        self._cond.notify_all()
+            cls.in_flight += 1
+            cls.admitted += 1
+            self.in_flight += 1
+
+    def release(self, name):
+        cls = self.classes[name]
+        with self._cond:
+            cls.in_flight -= 1
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            result = {"in_flight": self.in_flight, "max_in_flight": self.max_in_flight}
+            for cls in self.classes.values():
+                result[cls.name] = {
+                    "in_flight": cls.in_flight,
+                    "queue_depth": cls.waiting,
+                    "admitted": cls.admitted,
+                    "shed": cls.shed,
+                    "timeouts": cls.timeouts
+                }
+            return result
+
+
+class Admitted(object):
+    """
+    An admission slot for one call to Fusion, usable as a context manager.  It is a no-op if
+    admission control is disabled.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.controller = get_admission_controller()
+        if self.controller is not None and name not in self.controller.classes:
+            self.controller = None
+
+    def acquire(self):
+        if self.controller is not None:
+            self.controller.acquire(self.name)
+        return self
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+        return False
+
+    def release(self):
+        if self.controller is not None:
+            self.controller.release(self.name)
+            self.controller = None
+
+
+DEFAULT_CLASSES = {
+    "search": {"priority": 0, "limit": 40, "queue_size": 100, "queue_timeout": 2.0},
+    "suggest": {"priority": 1, "limit": 10, "queue_size": 20, "queue_timeout": 0.25},
+    "signals": {"priority": 2, "limit": 5, "queue_size": 50, "queue_timeout": 0.1}
+}
+
+
+def _new_admission_controller():
+    if not app.config.get("ADMISSION_ENABLED", False):
+        return None
+    classes = [TrafficClass(name, **settings)
+               for name, settings in app.config.get("ADMISSION_CLASSES", DEFAULT_CLASSES).items()]
+    return AdmissionController(app.config.get("ADMISSION_MAX_IN_FLIGHT", 50), classes)
+
+
+_admission_controller = PerProcess(_new_admission_controller)
+
+
+def get_admission_controller():
+    "The admission controller for this worker process, or None if admission control is disabled"
+    return _admission_controller.get()
+
+
+def _admission_stats():
+    controller = _admission_controller.peek()
+    if controller is not None:
+        return controller.stats()
+
+stats.register("admission", _admission_stats)
@@ -1,9 +1,13 @@
-from collections import namedtuple
+from collections import namedtuple, Mapping, OrderedDict, Sequence
 import importlib
 
 from server import app
 
 
+class SignalsRejected(Exception):
+  "The backend refused signals as invalid (rather than being unreachable or overloaded), so resending them won't help"
+
+
 class Backend(object):
   "Base class for Backend implementations"
 
@@ -16,6 +20,18 @@ class Backend(object):
     """
     raise NotImplementedError()
 
+  def send_signals(self, collection_id, payloads):
+    """
+    Send a batch of signals.  Backends with a bulk API should override this.
+
+    :param collection_id: the collection the signals are for
+    :param payloads: a list of Snowplow tracker payloads
+    :returns: True if all of them were sent
+    :raises SignalsRejected: if the backend refused them
+    """
+    results = [self.send_signal(collection_id, payload) for payload in payloads]
+    return all(results)
+
   def get_document(self, doc_id):
     """
     Fetch a single document from the backend
@@ -25,6 +41,15 @@ class Backend(object):
     """
     raise NotImplementedError()
 
+  def get_documents(self, ids):
+    """
+    Fetch many documents at once.  Backends that can look up several ids in one request should override this.
+
+    :param ids: a list of document ids
+    :returns: a list with the document for each id, in the same order, with None for ids that weren't found
+    """
+    return [self.get_document(doc_id) for doc_id in ids]
+
   def find_documents(self, query="*", source=None, author=None, project=None, limit=10, offset=0):
     """
     Filter and/or search for documents in the backend
@@ -35,10 +60,30 @@ class Backend(object):
     :param author: filter on the document's project field
     :param limit: limits how many results to return
     :param offset: how deeply into the results to start returning
-    :returns: a list of the resulting documents
+    :returns: a (documents, facets, number found) tuple.  documents is a sequence of Documents (e.g. a
+      DocumentList) and facets maps each facet field to an ordered dict of value -> count (e.g. a FacetCounts)
     """
     raise NotImplementedError()
 
+  def iter_documents(self, query="*", filters=None, batch_size=500):
+    """
+    Lazily iterate over every document matching a query.  Backends that can page with a cursor should
+    override this, as this one pages with find_documents' offsets.
+
+    :param query: a full text query
+    :param filters: a dict of source, author and/or project values to filter on
+    :param batch_size: how many documents to fetch from the backend at a time
+    :returns: an iterator of documents
+    """
+    offset = 0
+    while True:
+      docs, facets, found = self.find_documents(query, limit=batch_size, offset=offset, **(filters or {}))
+      for doc in docs:
+        yield doc
+      offset += len(docs)
+      if not docs or offset >= found:
+        break
+
   def create_collection(self, collection_id, enable_signals=False, enable_search_logs=True, enable_dynamic_schema=True):
     raise NotImplementedError()
 
@@ -112,6 +157,73 @@ class Backend(object):
 Document = namedtuple("Document", ["id", "author", "source", "project", "content", "created_at", "link"])
 
 
+class DocumentList(Sequence):
+  """
+  The documents of a search result, kept as the decoded backend docs and only turned into Documents
+  as they are accessed, so callers that just count them or want their ids don't pay for building them all.
+  Slices are DocumentLists too.
+  """
+
+  def __init__(self, docs, convert, partial=False):
+    """
+    :param docs: the decoded docs, e.g. dicts from Solr's JSON response
+    :param convert: callable turning one of them into a Document
+    :param partial: True if some of the places searched didn't answer, so documents may be missing
+    """
+    self._docs = docs
+    self._convert = convert
+    self.partial = partial
+
+  def __len__(self):
+    return len(self._docs)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return DocumentList(self._docs[index], self._convert, self.partial)
+    return self._convert(self._docs[index])
+
+  def __iter__(self):
+    for doc in self._docs:
+      yield self._convert(doc)
+
+  def ids(self):
+    return self.column("id")
+
+  def column(self, field):
+    "One field of every doc, without building Documents"
+    return [doc.get(field) for doc in self._docs]
+
+  def __repr__(self):
+    return "DocumentList({0!r})".format(list(self))
+
+
+class FacetCounts(Mapping):
+  """
+  Facet counts kept the way Solr returns them with json.nl=arrarr (field -> [[value, count], ...]).  Indexing
+  by field builds the ordered dict of value -> count for just that field, the first time it is asked for.
+  """
+
+  def __init__(self, facet_fields):
+    self._fields = facet_fields
+    self._built = {}
+
+  def __getitem__(self, field):
+    counts = self._built.get(field)
+    if counts is None:
+      counts = self._built[field] = OrderedDict((value, count) for value, count in self._fields[field])
+    return counts
+
+  def __iter__(self):
+    return iter(self._fields)
+
+  def __len__(self):
+    return len(self._fields)
+
+  def pairs(self, field):
+    "The [value, count] pairs of a field, most frequent first, as Solr returned them"
+    return self._fields[field]
+
+
 def get_backend():
   "Load the backend impl from config, default to the mock one"
   BACKEND = app.config.get("BACKEND", "server.backends.mock.MockBackend")
@@ -0,0 +1,58 @@
+from requests.adapters import HTTPAdapter
+from server import app
+from server.backends.fusion import FusionBackend
+# Call, Timeout and gather are what the *_async methods' callers work with
+from server.executor import Call, Executor, Timeout, gather
+from server.lazy import PerProcess
+
+
+class AsyncFusionBackend(FusionBackend):
+  """
+  A FusionBackend whose calls can also be started without waiting for them, so that independent ones (a search,
+  the documents it links to, a signal) overlap instead of running one after another:
+
+    search = backend.find_documents_async("solr", project="lucene")
+    related = backend.get_documents_async(ids)
+    docs, facets, found = search.get()
+
+  Python 2 has no asyncio, so each *_async method returns a Call, run by one of FUSION_ASYNC_MAX_CALLS workers per
+  process (greenlets under run_async.py).  The sessions' connection pools are sized to match.
+  """
+
+  def __init__(self):
+    super(AsyncFusionBackend, self).__init__()
+    self.max_calls = app.config.get("FUSION_ASYNC_MAX_CALLS", 20)
+    self._executor = PerProcess(self._new_executor)
+    for session in (self.admin_session, self.app_session):
+      adapter = HTTPAdapter(pool_connections=self.max_calls, pool_maxsize=self.max_calls)
+      session.mount("http://", adapter)
+      session.mount("https://", adapter)
+
+  def _new_executor(self):
+    return Executor("fusion_async", self.max_calls, max_queue=app.config.get("FUSION_ASYNC_MAX_QUEUE", 1000))
+
+  def call_async(self, fn, *args, **kwargs):
+    """
+    Start fn(*args, **kwargs) without waiting for it
+
+    :raises Overloaded: if FUSION_ASYNC_MAX_QUEUE calls are already waiting for a worker
+    """
+    return self._executor.get().submit(fn, *args, **kwargs)
+
+  def find_documents_async(self, query="*", source=None, author=None, project=None, limit=10, offset=0):
+    return self.call_async(self.find_documents, query, source, author, project, limit, offset)
+
+  def get_document_async(self, doc_id):
+    return self.call_async(self.get_document, doc_id)
+
+  def get_documents_async(self, ids):
+    return self.call_async(self.get_documents, ids)
+
+  def send_signal_async(self, collection_id, payload):
+    return self.call_async(self.send_signal, collection_id, payload)
+
+  def get_datasource_async(self, id):
+    return self.call_async(self.get_datasource, id)
+
+  def update_datasource_async(self, id, **config):
+    return self.call_async(self.update_datasource, id, **config)
@@ -1,50 +1,126 @@
+import base64
+import binascii
+import hashlib
 import json
+import os
+import re
 import requests
+import threading
+import time
 from collections import OrderedDict
 from dictdiffer import diff
-from server import app
-from server.backends import Backend, Document
+from server import app, jsoncodec, stats
+from server.backends import Backend, Document, DocumentList, FacetCounts, SignalsRejected
 from server.backends.github_helper import create_github_datasource_configs
 from server.backends.jira_helper import create_jira_datasource_config
 from server.backends.mailbox_helper import create_mailinglist_datasource_configs
 from server.backends.twitter_helper import create_twitter_datasource_configs
 from server.backends.website_helper import create_website_datasource_configs
 from server.backends.wiki_helper import create_wiki_datasource_configs
+from server.breaker import CircuitOpen, get_breaker, get_last_good
+from server.cache import VersionedCache
+from server.executor import Executor
+from server.lazy import PerProcess
+from server.nodes import get_node_pool, hedged
 from urlparse import urljoin
 
+# Solr fields to ask for, renamed to the Document fields they become
+DOCUMENT_FIELDS = ["id:id", "author:author_s", "source:source_s", "project:project", "content:content_t",
+                   "created_at:created_at_dt", "link:url"]
+# How find_documents facets its results
+FACET_PARAMS = {
+  "facet": True,
+  "facet.mincount": 1,
+  "facet.limit": 20,
+  "facet.order": "count",
+  "facet.field": ["source_s", "person_ss", "project"]
+}
+# The parts of a Solr search response we read; highlighting, debug etc. are skipped when decoding
+SEARCH_SECTIONS = ("response", "facet_counts")
+# Solr fields that find_documents' and iter_documents' filters apply to
+FILTER_FIELDS = {"source": "source_s", "author": "author_s", "project": "project"}
+# The Snowplow payload key that the signal aggregator puts the number of signals a combined one stands for
+# under; snowplow_to_signal turns it into the signal's count
+SIGNAL_COUNT_KEY = "_count"
+
 
 class FusionSession(requests.Session):
   """
   Wrapper around requests.Session that manages a cookie-based session
+
+  If balanced, requests are spread across the Fusion nodes of this process' NodePool (the one the proxy uses too)
+  instead of going to proxy_url, and GETs that fail to connect are retried on another node.
+
+  The backend is built at import time, before pre-forking servers (run_async.py, mod_wsgi) fork their workers,
+  so the first request in a new process drops the pooled connections inherited from the parent; otherwise every
+  worker would share the same keep-alive sockets.
   """
 
-  def __init__(self, proxy_url, username, password, lazy=False):
+  def __init__(self, proxy_url, username, password, lazy=False, balanced=False):
     super(FusionSession, self).__init__()
     self.__base_url = proxy_url
     self.proxy_url = proxy_url
     self.username = username
     self.password = password
+    self.balanced = balanced
+    self._pid = os.getpid()
+    self._pid_lock = threading.Lock()
     if not lazy:
       self._authenticate()
 
-  def _authenticate(self):
+  def _authenticate(self, base_url=None):
     headers = {"Content-type": "application/json"}
     data = {'username': self.username, 'password': self.password}
-    resp = self.post("session", data=json.dumps(data), headers=headers)
+    if base_url is None:
+      resp = self.post("session", data=json.dumps(data), headers=headers)
+    else:
+      resp = self._request(base_url, "POST", "session", data=json.dumps(data), headers=headers)
     if resp.status_code == 201:
       pass
     else:
       raise Exception("failed to authenticate, check credentials")
 
+  def get_json(self, url, sections=None, **kwargs):
+    """
+    GET url and decode the JSON response with the configured codec (see server.jsoncodec)
+
+    :param sections: if given, decode only these top-level keys of the response
+    :returns: a (response, decoded) tuple; decoded is None unless the status is 200
+    """
+    resp = self.get(url, **kwargs)
+    if resp.status_code != 200:
+      return resp, None
+    if sections is None:
+      return resp, jsoncodec.loads(resp.content)
+    return resp, jsoncodec.loads_sections(resp.content, sections)
+
+  def _drop_inherited_connections(self):
+    pid = os.getpid()
+    if self._pid != pid:
+      with self._pid_lock:
+        if self._pid != pid:
+          # closing the adapters empties their connection pools; they open new connections on demand
+          self.close()
+          self._pid = pid
+
   def request(self, method, url, **kwargs):
-    full_url = urljoin(self.__base_url, url)
+    self._drop_inherited_connections()
+    if not self.balanced:
+      return self._request(self.__base_url, method, url, **kwargs)
+    # looked up on every request rather than kept, as the pool (and its prober thread) is per process
+    return get_node_pool().call(lambda node: self._request(node.url + "/api/", method, url, **kwargs),
+                           retry=method == "GET", hedge=hedged(method, urljoin("/api/", url)))
+
+  def _request(self, base_url, method, url, **kwargs):
+    full_url = urljoin(base_url, url)
     resp = super(FusionSession, self).request(method, full_url, **kwargs)
     if resp.status_code == 401:
       if url == "session":
         return resp
       else:
         print("session expired, re-authenticating")
-        self._authenticate()
+        # each node hands out its own session cookie, so authenticate against the node that refused us
+        self._authenticate(base_url)
         return super(FusionSession, self).request(method, full_url, **kwargs)
     else:
       return resp
@@ -56,14 +132,102 @@ class FusionBackend(Backend):
     self.admin_session = FusionSession(
       app.config.get("FUSION_URL", "http://localhost:8764/api/"),
       app.config.get("FUSION_ADMIN_USERNAME"),
-      app.config.get("FUSION_ADMIN_PASSWORD")
+      app.config.get("FUSION_ADMIN_PASSWORD"),
+      balanced=_balanced()
     )
     self.app_session = FusionSession(
       app.config.get("FUSION_URL", "http://localhost:8764/api/"),
       app.config.get("FUSION_APP_USERNAME"),  # TODO change to another user
       app.config.get("FUSION_APP_PASSWORD"),
-      lazy=True
+      lazy=True,
+      balanced=_balanced()
     )
+    # where find_documents searches, unless there are FUSION_FEDERATED_TARGETS
+    self.local_target = {"name": "lucidfind", "collection": "lucidfind", "pipeline": "default",
+                         "session": self.app_session}
+    self.federated_targets = [self._federated_target(target)
+                              for target in app.config.get("FUSION_FEDERATED_TARGETS", [])]
+    self._result_cache = PerProcess(self._new_result_cache)
+    self._federated_executor = PerProcess(self._new_federated_executor)
+    stats.register("fusion_result_cache", self._result_cache_stats)
+
+  def _federated_target(self, target):
+    "Fill in a FUSION_FEDERATED_TARGETS entry, giving targets on other clusters a session of their own"
+    target = dict(target)
+    target.setdefault("collection", "lucidfind")
+    target.setdefault("pipeline", "default")
+    target.setdefault("name", target.get("url", "local") + "/" + target["collection"])
+    target.setdefault("timeout", app.config.get("FUSION_FEDERATED_TIMEOUT", 5))
+    if target.get("url"):
+      username = target.get("username", app.config.get("FUSION_APP_USER", app.config.get("FUSION_APP_USERNAME")))
+      target["session"] = FusionSession(target["url"],
+                                        username,
+                                        target.get("password", app.config.get("FUSION_APP_PASSWORD")),
+                                        lazy=True)
+    else:
+      target["session"] = self.app_session
+    return target
+
+  def _new_federated_executor(self):
+    if not self.federated_targets:
+      return None
+    return Executor("federated_search", app.config.get("FUSION_FEDERATED_MAX_CALLS", 20),
+                    max_queue=app.config.get("FUSION_FEDERATED_MAX_QUEUE", 100))
+
+  def _new_result_cache(self):
+    "The cache of search results and facet counts, if either of them is to be cached"
+    if not (app.config.get("FUSION_RESULT_CACHE_ENABLED", False) or
+              app.config.get("FUSION_FACET_CACHE_ENABLED", False)):
+      return None
+    jobs = app.config.get("FUSION_RESULT_CACHE_INVALIDATION", "index") == "jobs"
+    if jobs:
+      version_fn = self.jobs_version
+    else:
+      version_fn = lambda: self.index_version("lucidfind")
+    # index versions only grow, so an older one is a replica that hasn't caught up yet
+    cache = VersionedCache(version_fn, monotonic=not jobs,
+                           max_entries=app.config.get("FUSION_RESULT_CACHE_SIZE", 1000),
+                           poll_interval=app.config.get("FUSION_RESULT_CACHE_POLL_INTERVAL", 10))
+    return cache.start()
+
+  def _result_cache_stats(self):
+    cache = self._result_cache.peek()
+    if cache is not None:
+      return cache.stats()
+
+  def index_version(self, collection_id):
+    """
+    The version of a collection's Solr index, which changes with every commit that changed the index
+
+    Each replica (and shard) has an index version of its own, so this is rather the highest _version_ of any
+    document, which shard leaders hand out in increasing order, and the number of documents, which goes down
+    when documents are deleted.  It is the same whichever replicas answer, once they have caught up.
+
+    :returns: a (highest _version_, -number of documents) tuple, which grows with every change, or None if it
+      can't be had
+    """
+    resp, decoded = self.admin_session.get_json("apollo/solr/{0}/select".format(collection_id),
+                                                sections=("response",),
+                                                params={"q": "*:*", "rows": 1, "fl": "_version_",
+                                                        "sort": "_version_ desc", "wt": "json"})
+    if decoded is None:
+      return None
+    docs = decoded["response"]["docs"]
+    return (docs[0]["_version_"] if docs else 0), -decoded["response"]["numFound"]
+
+  def jobs_version(self):
+    """
+    A fingerprint of the state of every datasource job, which changes whenever a crawl starts or ends (but not as
+    it progresses, as its counters are left out)
+
+    :returns: the fingerprint, or None if it can't be had
+    """
+    resp = self.admin_session.get("apollo/connectors/jobs")
+    if resp.status_code != 200:
+      return None
+    states = sorted((job.get("id"), job.get("status", job.get("state")), job.get("startTime"), job.get("endTime"))
+                    for job in resp.json())
+    return hashlib.md5(json.dumps(states)).hexdigest()
 
   def add_field(self, collection_name, name, type="string", required=False, multivalued=False, indexed=True,
                 stored=True, defaultVal=None, copyDests=None):
@@ -153,11 +317,34 @@ class FusionBackend(Backend):
     resp = self.admin_session.get("apollo/signals/{0}/i".format(collection_id),
                                   # tack on the i so that we invoke the snowplow endpoint
                                   params=payload)
+    if _rejected(resp):
+      raise SignalsRejected(resp.text)
     if resp.status_code != 200:
       print "Unable to send signal: {0}".format(resp.text)
       return False
     return True
 
+  def send_signals(self, collection_id, payloads):
+    """
+    Send a batch of Snowplow events in one call to the bulk signals API
+    """
+    signals = [snowplow_to_signal(payload) for payload in payloads]
+    if None in signals:
+      # one malformed pixel mustn't sink the rest of the batch
+      print "Dropping {0} malformed signals".format(signals.count(None))
+      signals = [signal for signal in signals if signal is not None]
+      if not signals:
+        return True
+    resp = self.admin_session.post("apollo/signals/{0}".format(collection_id),
+                                   data=jsoncodec.dumps(signals),
+                                   headers={"Content-type": "application/json"})
+    if _rejected(resp):
+      raise SignalsRejected(resp.text)
+    if resp.status_code not in (200, 204):
+      print "Unable to send {0} signals: {1}".format(len(signals), resp.text)
+      return False
+    return True
+
   def get_role(self, rolename):
     resp = self.admin_session.get("roles")
     if resp.status_code == 200:
@@ -338,59 +525,208 @@ class FusionBackend(Backend):
                     created_at=solr_doc.get("created_at"), link=solr_doc.get("link"))
 
   def get_document(self, doc_id):
-    path = "apollo/query-pipelines/{1}/collections/{2}/select".format("default", "lucidfind")
-    params = {
-      "q": "*:*",
-      "fq": "id:{0}".format(doc_id),
-      "wt": "json"
-    }
-    resp = self.app_session.get(path, params=params, headers={"Content-type": "application/json"})
-    return self._from_solr_doc(resp.json()['response']['docs'][0])
+    return self.get_documents([doc_id])[0]
 
-  def find_documents(self, query="*", source=None, author=None, project=None, limit=10, offset=0):
+  def get_documents(self, ids):
+    """
+    Fetch many documents with one terms filter query per FUSION_GET_DOCUMENTS_CHUNK_SIZE ids
+    """
     path = "apollo/query-pipelines/{0}/collections/{1}/select".format("default", "lucidfind")
+    unique_ids = list(OrderedDict.fromkeys(ids))
+    chunk_size = app.config.get("FUSION_GET_DOCUMENTS_CHUNK_SIZE", 500)
+    found = {}
+    for start in range(0, len(unique_ids), chunk_size):
+      chunk = unique_ids[start:start + chunk_size]
+      params = {
+        "q": "*:*",
+        "fq": _terms_filter("id", chunk),
+        "rows": len(chunk),
+        "wt": "json"
+      }
+      resp, decoded = self.app_session.get_json(path, sections=SEARCH_SECTIONS, params=params,
+                                                headers={"Content-type": "application/json"})
+      if decoded is None:
+        raise Exception("Couldn't fetch documents: {0} {1}".format(resp.status_code, resp.text))
+      for solr_doc in decoded['response']['docs']:
+        found[solr_doc.get("id")] = self._from_solr_doc(solr_doc)
+    return [found.get(doc_id) for doc_id in ids]
+
+  def find_documents(self, query="*", source=None, author=None, project=None, limit=10, offset=0):
+    last_good = get_last_good()
+    if last_good is None:
+      return self._cached_find_documents(query, source, author, project, limit, offset)
+    key = ("find_documents", query, source, author, project, limit, offset)
+    try:
+      result = self._cached_find_documents(query, source, author, project, limit, offset)
+    except CircuitOpen:
+      # Fusion is failing: answer with what we found last time, if anything
+      result = last_good.get(key)
+      if result is None:
+        raise
+      return result
+    if not getattr(result[0], "partial", False):
+      last_good.put(key, result, _result_size(result))
+    return result
+
+  def _cached_find_documents(self, query, source, author, project, limit, offset):
+    cache = self._result_cache.get()
+    if cache is None:
+      return self._find_documents(query, source, author, project, limit, offset)
+    key = None
+    version = None
+    if app.config.get("FUSION_RESULT_CACHE_ENABLED", False):
+      key = ("results", query, source, author, project, limit, offset)
+      result, version = cache.get(key)
+      if result is not None:
+        return result
+    if app.config.get("FUSION_FACET_CACHE_ENABLED", False):
+      result = self._find_documents_cached_facets(cache, query, source, author, project, limit, offset)
+    else:
+      result = self._find_documents(query, source, author, project, limit, offset)
+    if key is not None and not getattr(result[0], "partial", False):
+      cache.put(key, result, version)
+    return result
+
+  def _find_documents_cached_facets(self, cache, query, source, author, project, limit, offset):
+    """
+    Search without faceting if the query's facets are cached (they don't depend on which page is asked for),
+    otherwise search with faceting and cache the facets that come back, so a cold query is still one request
+    """
+    facet_key = ("facets", query, source, author, project)
+    facets, version = cache.get(facet_key)
+    if facets is not None:
+      docs, no_facets, found = self._find_documents(query, source, author, project, limit, offset, facet=False)
+      return docs, facets, found
+    docs, facets, found = self._find_documents(query, source, author, project, limit, offset)
+    if not docs.partial:
+      cache.put(facet_key, facets, version)
+    return docs, facets, found
+
+  def _find_documents(self, query, source, author, project, limit, offset, facet=True):
+    filters = {"source": source, "author": author, "project": project}
+    if self.federated_targets:
+      return self._federated_find_documents(query, filters, limit, offset, facet)
+    decoded = self._search(self.local_target, query, filters, limit, offset, facet)
+    docs = DocumentList(decoded['response']['docs'], self._from_solr_doc)
+    # TODO rename facet fields?
+    facets = FacetCounts(decoded['facet_counts']['facet_fields']) if facet else None
+    found = decoded['response']['numFound']
+    return docs, facets, found
+
+  def _search(self, target, query, filters, limit, offset, facet, fields=DOCUMENT_FIELDS, timeout=None):
+    "Run a search against one collection on one cluster, returning the decoded response"
+    path = "apollo/query-pipelines/{0}/collections/{1}/select".format(target["pipeline"], target["collection"])
     # TODO move this to a QP config?
     params = {
       "q": query,
       "defType": "edismax",
       "qf": ["author_t^10", "person_t^8", "content_t^6", "source_s^4", "project^4"],
-      "fl": ["id:id", "author:author_s", "source:source_s", "project:project", "content:content_t",
-             "created_at:created_at_dt", "link:url"],
-      "fq": [],
+      "fl": fields,
+      "fq": _filter_queries(filters),
       "rows": limit,
       "start": offset,
-      "facet": True,
-      "facet.mincount": 1,
-      "facet.limit": 20,
-      "facet.order": "count",
-      "facet.field": ["source_s", "person_ss", "project"],
       "wt": "json",
       "json.nl": "arrarr"
     }
+    if facet:
+      params.update(FACET_PARAMS)
+    get_json = lambda: target["session"].get_json(path, sections=SEARCH_SECTIONS, params=params, timeout=timeout,
+                                                  headers={"Content-type": "application/json"})
+    breaker = get_breaker("find_documents:" + target["name"])
+    if breaker is None:
+      resp, decoded = get_json()
+    else:
+      resp, decoded = breaker.call(get_json, is_failure=lambda result: result[0].status_code >= 500)
+    if decoded is None:
+      raise Exception("Couldn't find documents in {0}: {1} {2}".format(target["name"], resp.status_code, resp.text))
+    return decoded
 
-    if source is not None:
-      params['fq'].append("source_s:{0}".format(source))
-    if author is not None:
-      params['fq'].append("author_s:{0}".format(author))
-    if project is not None:
-      params['fq'].append("project:{0}".format(project))
-    params['fq'].append("content_t:*")  # TODO is this a bug in the field mapper "set" op?
+  def _federated_find_documents(self, query, filters, limit, offset, facet):
+    """
+    Search every FUSION_FEDERATED_TARGETS target at once, on a pool of FUSION_FEDERATED_MAX_CALLS workers per
+    process, and merge what comes back within each target's timeout: hits by their score relative to the best one
+    of their own target (raw scores from different collections aren't comparable), facet counts by adding them up.
+    Each target only returns its own top values per facet field, so merged counts can undercount values that
+    didn't make every target's top list.  If a target failed or timed out, the DocumentList returned is flagged as
+    partial.
+    """
+    started = time.time()
 
-    resp = self.app_session.get(path, params=params, headers={"Content-type": "application/json"})
+    def search_target(target):
+      # the request only gets the time left, so a call that missed its deadline doesn't hold a worker for long
+      remaining = started + target["timeout"] - time.time()
+      if remaining <= 0:
+        return None
+      # every target's top offset + limit hits are needed to know which hits make the merged page
+      return self._search(target, query, filters, offset + limit, 0, facet,
+                          fields=DOCUMENT_FIELDS + ["score"], timeout=remaining)
 
-    decoded = resp.json()
-    docs = [self._from_solr_doc(doc) for doc in decoded['response']['docs']]
+    calls = []
+    executor = self._federated_executor.get()
+    for target in self.federated_targets:
+      try:
+        calls.append((target, executor.submit(search_target, target)))
+      except Exception as e:
+        print "Federated search of {0} failed: {1}".format(target["name"], e)
+        calls.append((target, None))
+    responded = []
+    for target, call in calls:
+      decoded = None
+      if call is not None:
+        try:
+          decoded = call.get(max(0, started + target["timeout"] - time.time()))
+        except Exception as e:
+          print "Federated search of {0} failed: {1}".format(target["name"], str(e) or "timed out")
+      responded.append(decoded)
+    # whatever finishes from here on is too late
+    partial = None in responded
+    responded = [decoded for decoded in responded if decoded is not None]
 
-    facets = decoded['facet_counts']['facet_fields']
-    ordered_facets = OrderedDict()
-    for field, field_facets in facets.items():
-      # TODO rename facet fields?
-      ordered_facets[field] = OrderedDict()
-      for value, count in field_facets:
-        ordered_facets[field][value] = count
+    hits = []
+    for decoded in responded:
+      docs = decoded['response']['docs']
+      best = decoded['response'].get("maxScore") or max([hit.get("score", 0) for hit in docs] or [0]) or 1
+      hits.extend((hit.get("score", 0) / float(best), hit) for hit in docs)
+    hits.sort(key=lambda scored: scored[0], reverse=True)
+    hits = [hit for score, hit in hits]
+    docs = DocumentList(hits[offset:offset + limit], self._from_solr_doc, partial=partial)
+    found = sum(decoded['response']['numFound'] for decoded in responded)
+    facets = None
+    if facet:
+      facets = _merge_facets([decoded['facet_counts']['facet_fields'] for decoded in responded],
+                             FACET_PARAMS["facet.limit"])
+    return docs, facets, found
 
-    found = decoded['response']['numFound']
-    return docs, ordered_facets, found
+  def iter_documents(self, query="*", filters=None, batch_size=500):
+    """
+    Page through every match with Solr's cursorMark, fetching batch_size documents at a time as the caller
+    consumes them.  Unlike start/rows paging, each page costs the same however deep it is.
+    """
+    path = "apollo/query-pipelines/{0}/collections/{1}/select".format("default", "lucidfind")
+    params = {
+      "q": query,
+      "defType": "edismax",
+      "qf": ["author_t^10", "person_t^8", "content_t^6", "source_s^4", "project^4"],
+      "fl": DOCUMENT_FIELDS,
+      "fq": _filter_queries(filters or {}),
+      "rows": batch_size,
+      # cursors need a total order on the unique key, and we want everything anyway
+      "sort": "id asc",
+      "wt": "json"
+    }
+    cursor = "*"
+    while True:
+      params["cursorMark"] = cursor
+      resp, decoded = self.app_session.get_json(path, sections=SEARCH_SECTIONS + ("nextCursorMark",),
+                                                params=params, headers={"Content-type": "application/json"})
+      if decoded is None:
+        raise Exception("Couldn't page through documents: {0} {1}".format(resp.status_code, resp.text))
+      for solr_doc in decoded['response']['docs']:
+        yield self._from_solr_doc(solr_doc)
+      next_cursor = decoded.get("nextCursorMark")
+      if next_cursor is None or next_cursor == cursor:
+        break
+      cursor = next_cursor
 
   def delete_taxonomy(self, collection_id, category=None):
     if category:
@@ -526,9 +862,57 @@ class FusionBackend(Backend):
       return resp.json()
 
 
+def _balanced():
+  "Whether sessions should spread requests over FUSION_NODES, rather than talk to FUSION_URL only"
+  return bool(app.config.get("FUSION_NODES"))
+
+
+def _result_size(result):
+  "Roughly how many bytes a find_documents result takes up: the text of its documents and facet values"
+  docs, facets, found = result
+  size = sum(len(value) for doc in docs for value in doc if isinstance(value, basestring))
+  return size + sum(len(value) for counts in facets.values() for value in counts)
+
+
+def _merge_facets(facet_fields_list, limit):
+  "Add up several responses' facet counts, keeping the top limit values of each field"
+  totals = OrderedDict()
+  for facet_fields in facet_fields_list:
+    for field, pairs in facet_fields.items():
+      counts = totals.setdefault(field, {})
+      for value, count in pairs:
+        counts[value] = counts.get(value, 0) + count
+  return FacetCounts(OrderedDict(
+    (field, sorted(([value, count] for value, count in counts.items()), key=lambda pair: -pair[1])[:limit])
+    for field, counts in totals.items()))
+
+
+def _filter_queries(filters):
+  "The fq params for a dict of source, author and/or project filters"
+  fq = [u"{0}:{1}".format(FILTER_FIELDS[name], value) for name, value in sorted(filters.items()) if value is not None]
+  fq.append("content_t:*")  # TODO is this a bug in the field mapper "set" op?
+  return fq
+
+
+def _solr_quote(value):
+  "A value as a quoted term for the standard Solr query parser"
+  return u'"{0}"'.format(re.sub(r'(["\\])', r"\\\1", value))
+
+
+def _terms_filter(field, values):
+  """
+  A Solr terms query matching any of values in field, split on a separator that none of the values contain.  If
+  every separator is taken, it is an OR of the quoted values instead.
+  """
+  for separator in (",", "|", "\t", "\x1f"):
+    if not any(separator in value for value in values):
+      return u"{{!terms f={0} separator='{1}'}}{2}".format(field, separator, separator.join(values))
+  return u"{0}:({1})".format(field, u" OR ".join(_solr_quote(value) for value in values))
+
+
 def _new_session(proxy_url, username, password):
   "Establishes a cookie-based session with the Fusion proxy node"
-  session = FusionSession(proxy_url, username, password)
+  session = FusionSession(proxy_url, username, password, balanced=_balanced())
   return session
 
 
@@ -548,6 +932,82 @@ def new_user_session():
   )
 
 
+def _rejected(resp):
+  "Whether Fusion refused signals as invalid, as opposed to failing in a way that's worth retrying"
+  return 400 <= resp.status_code < 500 and resp.status_code not in (401, 408, 429)
+
+
+def tracker_param(payload, key, default=None):
+  "One Snowplow tracker parameter of a payload; the first value if it was sent more than once"
+  value = payload.get(key, default)
+  if isinstance(value, list):
+    return value[0] if value else default
+  return value
+
+
+def _snowplow_json(payload, plain_key, encoded_key):
+  """
+  Decode one of Snowplow's JSON parameters, which come either plain or as unpadded urlsafe base64
+
+  :returns: the decoded value, or None if the parameter is missing or malformed
+  """
+  try:
+    if plain_key in payload:
+      raw = tracker_param(payload, plain_key)
+    elif encoded_key in payload:
+      encoded = str(tracker_param(payload, encoded_key))
+      raw = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+    else:
+      return None
+    return json.loads(raw)
+  except (TypeError, binascii.Error, ValueError):
+    return None
+
+
+def _self_describing_data(value):
+  "Pull the innermost data objects out of Snowplow self-describing JSON"
+  if isinstance(value, list):
+    return [data for item in value for data in _self_describing_data(item)]
+  if isinstance(value, dict):
+    if "schema" in value and "data" in value:
+      return _self_describing_data(value["data"])
+    return [value]
+  return []
+
+
+def snowplow_to_signal(payload):
+  """
+  Convert the parameters of a Snowplow tracker request into a Fusion signal for the bulk signals API
+
+  The fields of any unstructured event and contexts (e.g. the docId and query of a click) are merged into
+  the signal's params, and their signalType, if any, becomes the signal's type.  An aggregated signal's weight
+  (see SIGNAL_COUNT_KEY) becomes its count, which Fusion's signal aggregation adds up.
+
+  :returns: the signal, or None if the event's JSON parameters can't be decoded
+  """
+  params = dict(payload)
+  count = params.pop(SIGNAL_COUNT_KEY, None)
+  for plain_key, encoded_key in (("ue_pr", "ue_px"), ("co", "cx")):
+    # the raw JSON (or base64 of it) is dropped in favour of the fields decoded from it
+    present = plain_key in params or encoded_key in params
+    params.pop(plain_key, None)
+    params.pop(encoded_key, None)
+    decoded = _snowplow_json(payload, plain_key, encoded_key)
+    if present and decoded is None:
+      return None
+    for data in _self_describing_data(decoded):
+      params.update(data)
+  signal = {
+    "type": params.get("signalType") or tracker_param(payload, "e", "snowplow"),
+    "params": params
+  }
+  if str(tracker_param(payload, "dtm", "")).isdigit():
+    signal["timestamp"] = int(tracker_param(payload, "dtm"))
+  if count is not None:
+    signal["count"] = int(count)
+  return signal
+
+
 def compare_datasources(test_datasource, target_datasource):
   """
   Test if test_datasource is a subset of target_datasource
@@ -13,6 +13,9 @@ class MockBackend(Backend):
     def get_document(self, doc_id):
         return _gen_fake_docs(1).next()
 
+    def get_documents(self, ids):
+        return [doc._replace(id=doc_id) for doc_id, doc in zip(ids, _gen_fake_docs(len(ids)))]
+
     def find_documents(self, query="*", source=None, author=None, project=None, limit=10, offset=0):
         docs = list(_gen_fake_docs(limit, author, source, project))
         facets = _gen_fake_facets(docs, author, source, project)
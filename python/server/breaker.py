@@ -0,0 +1,247 @@
+import logging
+import threading
+import time
+from collections import deque, OrderedDict
+
+from server import app, stats
+from server.admission import Overloaded
+from server.lazy import PerProcess
+
+LOG = logging.getLogger("breaker.py")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Overloaded):
+    "Raised instead of calling Fusion on a route whose circuit is open"
+
+    def __init__(self, route):
+        super(CircuitOpen, self).__init__(route, "circuit open")
+        self.route = route
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a route of Fusion's that keeps failing, so callers fail fast instead of waiting out timeouts.
+
+    Calls that raise, return something is_failure rejects (e.g. a 5xx) or take longer than slow_seconds count as
+    failures.  Once at least min_calls of the last window calls were made and failure_rate of them failed, the
+    circuit opens and calls are refused with CircuitOpen.  After open_seconds it goes half open: one probe call
+    is let through, and the circuit closes if it succeeds or opens again if it doesn't.
+    """
+
+    def __init__(self, route, failure_rate=0.5, slow_seconds=5.0, window=20, min_calls=10, open_seconds=30,
+                 clock=time.time):
+        self.route = route
+        self.failure_rate = failure_rate
+        self.slow_seconds = slow_seconds
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.clock = clock
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.opened = 0
+
+    def allow(self):
+        "Whether a call may go ahead now.  In the half open state only one caller at a time gets True"
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if self.clock() - self._opened_at < self.open_seconds:
+                    self.rejected += 1
+                    return False
+                self.state = HALF_OPEN
+                self._probing = False
+            if self._probing:
+                self.rejected += 1
+                return False
+            self._probing = True
+            return True
+
+    def record(self, ok, elapsed):
+        "Count the outcome of a call that allow() let through"
+        failed = not ok or elapsed > self.slow_seconds
+        with self._lock:
+            self.calls += 1
+            if failed:
+                self.failures += 1
+            if self.state == HALF_OPEN:
+                self._probing = False
+                if failed:
+                    self._open()
+                else:
+                    LOG.info("Closing the circuit for %s", self.route)
+                    self.state = CLOSED
+                    self._outcomes.clear()
+            elif self.state == CLOSED:
+                self._outcomes.append(failed)
+                if (len(self._outcomes) >= self.min_calls and
+                        sum(self._outcomes) >= self.failure_rate * len(self._outcomes)):
+                    self._open()
+
+    def _open(self):
+        LOG.warning("Opening the circuit for %s", self.route)
+        self.state = OPEN
+        self._opened_at = self.clock()
+        self.opened += 1
+
+    def cancel(self):
+        "Forget a call that allow() let through but that never reached Fusion"
+        with self._lock:
+            self._probing = False
+
+    def call(self, fn, is_failure=None):
+        """
+        Run fn() if the circuit allows it
+
+        :param is_failure: callable telling whether what fn returned counts as a failure
+        :raises CircuitOpen: if the circuit is open
+        """
+        if not self.allow():
+            raise CircuitOpen(self.route)
+        started = self.clock()
+        try:
+            result = fn()
+        except Overloaded:
+            # shed on our side, Fusion never saw it
+            self.cancel()
+            raise
+        except Exception:
+            self.record(False, self.clock() - started)
+            raise
+        self.record(is_failure is None or not is_failure(result), self.clock() - started)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "calls": self.calls,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "opened": self.opened
+            }
+
+
+class LastGoodStore(object):
+    """
+    The last good result per key, kept for at most max_age seconds, to answer with while a circuit is open.
+    Capped at max_entries keys and max_bytes in all (by the sizes given to put), least recently stored
+    go first.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024, max_age=3600, clock=time.time):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.served = 0
+
+    def put(self, key, value, size):
+        "Store value as the last good result for key.  size is roughly how many bytes it holds"
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (self.clock(), value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[2]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self.clock() - entry[0] > self.max_age:
+                return None
+            self.served += 1
+            return entry[1]
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "served": self.served}
+
+
+class Breakers(object):
+    "One CircuitBreaker per route, made on first use"
+
+    def __init__(self, **settings):
+        self.settings = settings
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, route):
+        with self._lock:
+            breaker = self._breakers.get(route)
+            if breaker is None:
+                breaker = self._breakers[route] = CircuitBreaker(route, **self.settings)
+            return breaker
+
+    def stats(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return dict((breaker.route, breaker.stats()) for breaker in breakers)
+
+
+def _new_breakers():
+    if not app.config.get("BREAKER_ENABLED", False):
+        return None
+    return Breakers(failure_rate=app.config.get("BREAKER_FAILURE_RATE", 0.5),
+                    slow_seconds=app.config.get("BREAKER_SLOW_SECONDS", 5.0),
+                    window=app.config.get("BREAKER_WINDOW", 20),
+                    min_calls=app.config.get("BREAKER_MIN_CALLS", 10),
+                    open_seconds=app.config.get("BREAKER_OPEN_SECONDS", 30))
+
+
+_breakers = PerProcess(_new_breakers)
+
+
+def get_breaker(route):
+    "The circuit breaker for route in this worker process, or None if breakers are off"
+    breakers = _breakers.get()
+    if breakers is None:
+        return None
+    return breakers.get(route)
+
+
+def _new_last_good():
+    if not app.config.get("BREAKER_ENABLED", False) or not app.config.get("BREAKER_SERVE_STALE", True):
+        return None
+    return LastGoodStore(max_entries=app.config.get("BREAKER_STALE_MAX_ENTRIES", 1000),
+                         max_bytes=app.config.get("BREAKER_STALE_MAX_BYTES", 64 * 1024 * 1024),
+                         max_age=app.config.get("BREAKER_STALE_MAX_AGE", 3600))
+
+
+_last_good = PerProcess(_new_last_good)
+
+
+def get_last_good():
+    "The store of last good results to fall back on while a circuit is open, or None if that's off"
+    return _last_good.get()
+
+
+def _breaker_stats():
+    breakers = _breakers.peek()
+    if breakers is None:
+        return None
+    result = {"routes": breakers.stats()}
+    last_good = _last_good.peek()
+    if last_good is not None:
+        result["stale"] = last_good.stats()
+    return result
+
+stats.register("circuit_breakers", _breaker_stats)
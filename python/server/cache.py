@@ -0,0 +1,252 @@
+import threading
+import time
+import urllib
+import urlparse
+from collections import namedtuple, OrderedDict
+
+# A fully buffered upstream response.  headers is a list of (name, value) tuples.
+CachedResponse = namedtuple("CachedResponse", ["status", "headers", "body"])
+
+FRESH = "fresh"
+STALE = "stale"
+
+
+def canonical_key(path, query_string, *variants):
+    """
+    Build a cache key from a path and query string that does not depend on the order of the parameters
+
+    :param path: the request path, without the query string
+    :param query_string: the raw query string
+    :param variants: any extra request attributes the response depends on (e.g. the accepted encoding)
+    :returns: the key
+    """
+    params = sorted(urlparse.parse_qsl(query_string or "", keep_blank_values=True))
+    key = path
+    if params:
+        key += "?" + urllib.urlencode(params)
+    if variants:
+        key += "|" + "|".join(v or "" for v in variants)
+    return key
+
+
+class _Entry(object):
+    __slots__ = ("value", "size", "expires_at", "stale_until")
+
+    def __init__(self, value, size, expires_at, stale_until):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+        self.stale_until = stale_until
+
+
+def response_size(key, value):
+    "The bytes a CachedResponse takes up under key, as far as the caches' byte caps are concerned"
+    return len(key) + len(value.body) + sum(len(k) + len(v) for k, v in value.headers)
+
+
+class ResponseCache(object):
+    """
+    Bounded LRU + TTL cache of upstream responses.
+
+    The cache is capped by the total size of the cached bodies and headers rather
+    than by a number of entries.  The TTL is chosen per path prefix (the longest
+    matching prefix in ttl_rules wins); paths with no TTL are not cached.  Once an
+    entry is past its TTL it may still be served for stale_seconds while a fresh
+    copy is fetched in the background.
+    """
+
+    def __init__(self, max_bytes, ttl_rules=None, default_ttl=0, stale_seconds=0, clock=time.time):
+        self.max_bytes = max_bytes
+        self.ttl_rules = sorted((ttl_rules or {}).items(), key=lambda rule: len(rule[0]), reverse=True)
+        self.default_ttl = default_ttl
+        self.stale_seconds = stale_seconds
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def ttl_for(self, path):
+        "The time to live for responses to path, 0 if they should not be cached"
+        for prefix, ttl in self.ttl_rules:
+            if path.startswith(prefix):
+                return ttl
+        return self.default_ttl
+
+    def get(self, key):
+        """
+        Look up a response
+
+        :returns: a (CachedResponse, FRESH|STALE) tuple, or (None, None) on a miss
+        """
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None, None
+            if now >= entry.stale_until:
+                self._bytes -= entry.size
+                self.misses += 1
+                return None, None
+            # re-insert to mark it as most recently used
+            self._entries[key] = entry
+            if now < entry.expires_at:
+                self.hits += 1
+                return entry.value, FRESH
+            self.stale_hits += 1
+            return entry.value, STALE
+
+    def put(self, key, value, ttl):
+        "Store a response for ttl seconds, evicting the least recently used entries to stay under max_bytes"
+        size = response_size(key, value)
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        now = self.clock()
+        entry = _Entry(value, size, now + ttl, now + ttl + self.stale_seconds)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[key] = entry
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self.evictions += 1
+
+    def start_refresh(self, key):
+        "Claim the background refresh of a stale key.  Returns False if another thread is already refreshing it"
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def end_refresh(self, key):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+
+class VersionedCache(object):
+    """
+    Bounded LRU cache whose entries are only good for one version of the data behind them.
+
+    A background thread polls version_fn every poll_interval seconds and drops everything
+    when the version changes, so nothing cached survives a change by more than one poll.
+    While the version can't be fetched, nothing is served or stored.  Callers take the
+    version along with a miss and hand it back to put(), so that a value computed against
+    an older version is never stored under the new one.  With monotonic, versions only
+    move forward: a poll answered with an older version than the current one is ignored,
+    so sources that lag behind now and then (e.g. Solr replicas) don't flush the cache.
+    """
+
+    def __init__(self, version_fn, max_entries=1000, poll_interval=10, monotonic=False):
+        """
+        :param version_fn: no-arg callable returning the current version (anything comparable with ==, and with <
+            if monotonic), or None
+        """
+        self.version_fn = version_fn
+        self.monotonic = monotonic
+        self.max_entries = max_entries
+        self.poll_interval = poll_interval
+        self.version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.poll_failures = 0
+
+    def get(self, key):
+        """
+        Look up a value
+
+        :returns: a (value, version) tuple; value is None on a miss
+        """
+        with self._lock:
+            version = self.version
+            value = self._entries.pop(key, None) if version is not None else None
+            if value is None:
+                self.misses += 1
+            else:
+                self._entries[key] = value
+                self.hits += 1
+            return value, version
+
+    def put(self, key, value, version):
+        "Store a value computed against version, unless the version has moved on since"
+        with self._lock:
+            if version is None or version != self.version:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def set_version(self, version):
+        with self._lock:
+            if self.monotonic and None not in (version, self.version) and version < self.version:
+                return
+            if version != self.version:
+                if self._entries:
+                    self.invalidations += 1
+                self._entries.clear()
+                self.version = version
+
+    def poll(self):
+        try:
+            version = self.version_fn()
+        except Exception:
+            version = None
+        if version is None:
+            with self._lock:
+                self.poll_failures += 1
+        self.set_version(version)
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            self.poll()
+
+    def start(self):
+        if self._thread is None:
+            self.poll()
+            self._thread = threading.Thread(target=self._run, name="versioned-cache-poller")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "version": None if self.version is None else str(self.version),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "poll_failures": self.poll_failures
+            }
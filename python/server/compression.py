@@ -0,0 +1,52 @@
+import zlib
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml", "application/x-javascript")
+
+
+def accepts_gzip(accept_encoding):
+    "Whether an Accept-Encoding header allows gzip (q=0 counts as a refusal)"
+    for coding in (accept_encoding or "").split(","):
+        parts = [p.strip() for p in coding.split(";")]
+        if parts[0].lower() in ("gzip", "*"):
+            return not any(p.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000") for p in parts[1:])
+    return False
+
+
+def should_compress(headers, min_bytes):
+    """
+    Whether we should gzip a response ourselves
+
+    :param headers: the response headers, as a dict-like object
+    :param min_bytes: don't bother below this size; responses of unknown length are always compressed
+    """
+    if headers.get("Content-Encoding"):
+        return False
+    content_type = headers.get("Content-Type", "")
+    if not content_type.startswith(COMPRESSIBLE_TYPES):
+        return False
+    length = headers.get("Content-Length")
+    return length is None or int(length) >= min_bytes
+
+
+def _gzip_compressor(level):
+    # wbits > 15 makes zlib write a gzip header and trailer
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def gzip_bytes(body, level=6):
+    compressor = _gzip_compressor(level)
+    return compressor.compress(body) + compressor.flush()
+
+
+def gzip_stream(chunks, level=6):
+    "gzip an iterable of byte chunks as it is consumed, without holding on to more than one chunk"
+    compressor = _gzip_compressor(level)
+    try:
+        for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
@@ -0,0 +1,91 @@
+import Queue
+import sys
+import threading
+import time
+
+from server.admission import Overloaded
+
+
+class Timeout(Exception):
+    "A call didn't finish in time"
+
+
+class Call(object):
+    "A call running concurrently with the caller, like a future"
+
+    def __init__(self, fn, args, kwargs):
+        self._fn = fn
+        self._args = args
+        self._kwargs = kwargs
+        self._done = threading.Event()
+        self._value = None
+        self._exc_info = None
+
+    def _run(self):
+        try:
+            self._value = self._fn(*self._args, **self._kwargs)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._done.set()
+
+    def ready(self):
+        return self._done.is_set()
+
+    def get(self, timeout=None):
+        """
+        Wait for the call to finish
+
+        :returns: what the call returned; if it raised, this raises the same exception
+        :raises Timeout: if it didn't finish within timeout seconds
+        """
+        if not self._done.wait(timeout):
+            raise Timeout()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+
+def gather(calls, timeout=None):
+    "Wait for several calls, returning their results in order.  timeout is for all of them together"
+    if timeout is None:
+        return [call.get() for call in calls]
+    deadline = time.time() + timeout
+    return [call.get(max(0, deadline - time.time())) for call in calls]
+
+
+class Executor(object):
+    """
+    A fixed number of workers running Calls from a bounded queue.  Under run_async.py (gevent, with the standard
+    library monkey patched) the workers are greenlets, otherwise threads.  Build these per process (see PerProcess).
+
+    Starting a call never blocks: once max_queue calls are waiting it is refused with Overloaded.  A call started
+    from one of the workers runs right away on that worker instead of being queued, so calls that start other calls
+    and wait for them can't tie up every worker waiting on each other.
+    """
+
+    def __init__(self, name, workers, max_queue=1000):
+        self.name = name
+        self._queue = Queue.Queue(max_queue)
+        self._local = threading.local()
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name=name)
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        self._local.worker = True
+        while True:
+            self._queue.get()._run()
+
+    def submit(self, fn, *args, **kwargs):
+        "Start fn(*args, **kwargs), returning its Call"
+        call = Call(fn, args, kwargs)
+        if getattr(self._local, "worker", False):
+            call._run()
+            return call
+        try:
+            self._queue.put_nowait(call)
+        except Queue.Full:
+            raise Overloaded(self.name, "queue full")
+        return call
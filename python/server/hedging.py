@@ -0,0 +1,168 @@
+import Queue
+import sys
+import threading
+import time
+from collections import deque
+
+
+class LatencyTracker(object):
+    "Percentiles of the last window latencies, recomputed every recompute_every samples"
+
+    def __init__(self, window=1000, recompute_every=50):
+        self.recompute_every = recompute_every
+        self._samples = deque(maxlen=window)
+        self._since_recompute = 0
+        self._percentiles = {}
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._since_recompute += 1
+            if self._since_recompute >= self.recompute_every:
+                self._percentiles = {}
+                self._since_recompute = 0
+
+    def count(self):
+        return len(self._samples)
+
+    def percentile(self, p):
+        with self._lock:
+            if not self._samples:
+                return None
+            if p not in self._percentiles:
+                ordered = sorted(self._samples)
+                self._percentiles[p] = ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+            return self._percentiles[p]
+
+
+class Hedger(object):
+    """
+    Hedged requests against a NodePool, to cut the tail latency that one slow node adds.
+
+    The call goes to the best node as usual.  If it hasn't answered after the observed percentile
+    latency of recent calls, the same call is also sent to another node and whichever answers
+    first wins.  The loser can't be stopped once sent, so its response is closed as soon as it
+    arrives, which hands its connection back to the pool.  Hedges are rationed by a token bucket
+    that earns max_rate tokens per call (up to burst), so at most about max_rate of the calls
+    are ever doubled, however slow Fusion gets.  Only use this for idempotent calls.
+    """
+
+    def __init__(self, percentile=95, min_delay=0.01, max_rate=0.05, burst=10, min_samples=100, window=1000):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_rate = max_rate
+        self.burst = burst
+        self.min_samples = min_samples
+        self.latencies = LatencyTracker(window)
+        self._tokens = burst
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedges = 0
+        self.hedges_won = 0
+        self.hedges_suppressed = 0
+
+    def delay(self):
+        "How long to wait for the first node before hedging, or None while there are too few samples"
+        if self.latencies.count() < self.min_samples:
+            return None
+        return max(self.min_delay, self.latencies.percentile(self.percentile))
+
+    def _take_token(self):
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.hedges += 1
+                return True
+            self.hedges_suppressed += 1
+            return False
+
+    def call(self, pool, fn, stream=False):
+        """
+        Run fn(node) against pool, hedging it on another node if it is slow (see NodePool.call for stream)
+
+        :returns: the first successful response (or the last failure, raised, if every attempt failed)
+        """
+        with self._lock:
+            self.calls += 1
+            self._tokens = min(self.burst, self._tokens + self.max_rate)
+        delay = self.delay()
+        if delay is None or len(pool) < 2:
+            return self._attempt(pool, fn, (), stream=stream)
+
+        results = Queue.Queue()
+        state = {"done": False}
+        primary_nodes = []
+
+        def attempt(name, exclude, used):
+            try:
+                resp = self._attempt(pool, fn, exclude, used, stream)
+            except Exception:
+                results.put((name, None, sys.exc_info()))
+                return
+            with self._lock:
+                late = state["done"]
+                if not late:
+                    results.put((name, resp, None))
+            if late:
+                resp.close()
+
+        self._spawn(attempt, "primary", (), primary_nodes)
+        pending = 1
+        try:
+            name, resp, exc_info = results.get(timeout=delay)
+        except Queue.Empty:
+            if self._take_token():
+                self._spawn(attempt, "hedge", list(primary_nodes), [])
+                pending += 1
+            name, resp, exc_info = results.get()
+        pending -= 1
+        while exc_info is not None and pending:
+            # one attempt failed, the other may still come through
+            name, resp, exc_info = results.get()
+            pending -= 1
+        with self._lock:
+            state["done"] = True
+            if name == "hedge" and exc_info is None:
+                self.hedges_won += 1
+        # anything that arrived between the winner and the flag above is closed here
+        while True:
+            try:
+                late_name, late_resp, late_exc_info = results.get_nowait()
+            except Queue.Empty:
+                break
+            if late_resp is not None:
+                late_resp.close()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return resp
+
+    def _attempt(self, pool, fn, exclude, used=None, stream=False):
+        "One timed pool call.  Only successful calls count towards the latency percentiles"
+
+        def timed(node):
+            if used is not None:
+                used.append(node)
+            return fn(node)
+
+        started = time.time()
+        resp = pool.call(timed, retry=True, exclude=exclude, stream=stream)
+        elapsed = time.time() - started
+        if resp.status_code < 500:
+            self.latencies.add(elapsed)
+        return resp
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args, name="hedged-request")
+        thread.daemon = True
+        thread.start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedges_won": self.hedges_won,
+                "hedges_suppressed": self.hedges_suppressed,
+                "delay_seconds": self.delay()
+            }
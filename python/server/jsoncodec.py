@@ -0,0 +1,82 @@
+import json
+import logging
+from io import BytesIO
+
+from server import app
+
+LOG = logging.getLogger("jsoncodec.py")
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+try:
+    import ijson
+    # only worth it with the C parser: the pure Python ones are slower than decoding everything with json
+    _ijson = ijson.get_backend("yajl2_c")
+    from ijson.common import ObjectBuilder
+    # use_float (rather than Decimals) needs ijson 3.1
+    list(_ijson.parse(BytesIO(b"[1.5]"), use_float=True))
+except Exception:
+    _ijson = None
+
+
+def _compact_json_dumps(value):
+    return json.dumps(value, separators=(",", ":"))
+
+
+def _codec(name):
+    "The (name, loads, dumps) to use for JSON_CODEC name: auto, ujson, simplejson or json"
+    if name in ("auto", "ujson") and ujson is not None:
+        return "ujson", ujson.loads, lambda value: ujson.dumps(value, escape_forward_slashes=False)
+    if name in ("auto", "simplejson") and simplejson is not None:
+        return "simplejson", simplejson.loads, lambda value: simplejson.dumps(value, separators=(",", ":"))
+    if name not in ("auto", "json"):
+        LOG.warning("JSON codec %s is not available, using json", name)
+    return "json", json.loads, _compact_json_dumps
+
+
+codec_name, loads, dumps = _codec(app.config.get("JSON_CODEC", "auto"))
+streaming = _ijson is not None and app.config.get("JSON_STREAMING_DECODE", True)
+
+
+def _build(events):
+    "Build the value that starts with the next event, consuming only its events"
+    builder = ObjectBuilder()
+    depth = 0
+    for prefix, event, value in events:
+        builder.event(event, value)
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+        if depth == 0:
+            return builder.value
+
+
+def loads_sections(body, sections):
+    """
+    Decode only some of the top-level keys of a JSON object, e.g. ("response", "facet_counts") of a Solr response
+
+    With the ijson C parser everything else (highlighting, debug, ...) is scanned but never turned into Python
+    objects.  Without it the whole body is decoded and the other keys are dropped.
+
+    :param body: the JSON text
+    :param sections: the top-level keys to keep
+    :returns: a dict holding just those keys that were present
+    """
+    if not streaming:
+        decoded = loads(body)
+        return dict((key, decoded[key]) for key in sections if key in decoded)
+    result = {}
+    events = _ijson.parse(BytesIO(body), use_float=True)
+    for prefix, event, value in events:
+        if prefix == "" and event == "map_key" and value in sections:
+            result[value] = _build(events)
+            if len(result) == len(sections):
+                break
+    return result
@@ -0,0 +1,34 @@
+import os
+import threading
+
+
+class PerProcess(object):
+    """
+    Lazily build one instance of something per worker process.
+
+    Connection pools and background threads must not be shared across a fork
+    (mod_wsgi, pre-forking servers), so instead of creating them at import time
+    we build them on first use and rebuild them if we find ourselves in a new
+    process.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._pid = None
+        self._instance = None
+
+    def get(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._instance = self._factory()
+                    self._pid = pid
+        return self._instance
+
+    def peek(self):
+        "Return the instance for this process if it has already been built, else None"
+        if self._pid == os.getpid():
+            return self._instance
+        return None
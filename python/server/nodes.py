@@ -0,0 +1,243 @@
+import logging
+import threading
+import time
+
+import requests
+
+from server import app, stats
+from server.hedging import Hedger
+from server.lazy import PerProcess
+
+LOG = logging.getLogger("nodes.py")
+
+
+class Node(object):
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.ejected_at = None
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+
+
+class NodePool(object):
+    """
+    A set of interchangeable Fusion API nodes.
+
+    Calls go to the healthy node with the fewest outstanding requests.  A node that fails
+    max_failures calls in a row (connection errors, timeouts or 5xx) is ejected until a
+    background health probe readmits it, or, when probes aren't running, eject_seconds later.
+    Idempotent calls that fail to connect are retried on another node, and, if the pool has a
+    Hedger, slow ones can be hedged on another node.
+    """
+
+    def __init__(self, urls, max_failures=3, eject_seconds=30, probe_path="/api", probe_interval=5, probe_timeout=2):
+        self.nodes = [Node(url) for url in urls]
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.probe_path = probe_path
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.retries = 0
+        self.hedger = None
+        self._lock = threading.Lock()
+        self._prober = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def acquire(self, exclude=()):
+        "Pick the least loaded healthy node not in exclude and count a request against it"
+        now = time.time()
+        with self._lock:
+            candidates = [n for n in self.nodes if n not in exclude] or self.nodes
+            if self._prober is None:
+                for node in candidates:
+                    if not node.healthy and now - node.ejected_at >= self.eject_seconds:
+                        self._readmit(node)
+            # If everything is ejected, trying a node beats failing outright
+            healthy = [n for n in candidates if n.healthy] or candidates
+            node = min(healthy, key=lambda n: n.outstanding)
+            node.outstanding += 1
+            node.requests += 1
+            return node
+
+    def release(self, node, ok=True):
+        with self._lock:
+            node.outstanding -= 1
+            if ok:
+                node.consecutive_failures = 0
+            else:
+                node.failures += 1
+                node.consecutive_failures += 1
+                if node.healthy and node.consecutive_failures >= self.max_failures:
+                    self._eject(node)
+
+    def _eject(self, node):
+        LOG.warning("Ejecting Fusion node %s", node.url)
+        node.healthy = False
+        node.ejected_at = time.time()
+        node.ejections += 1
+
+    def _readmit(self, node):
+        LOG.info("Readmitting Fusion node %s", node.url)
+        node.healthy = True
+        node.consecutive_failures = 0
+        node.ejected_at = None
+
+    def _release_on_close(self, resp, node, ok):
+        "Keep counting a streamed response against node until its body is done with, i.e. it is closed"
+        close = resp.close
+        released = []
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if not released:
+                    released.append(True)
+                    self.release(node, ok)
+
+        resp.close = close_and_release
+
+    def call(self, fn, retry=False, exclude=(), hedge=False, stream=False):
+        """
+        Run fn(node) against the best node
+
+        :param fn: does the request against the given node and returns a requests Response
+        :param retry: if the call is idempotent, retry it on another node when it fails to connect
+        :param exclude: nodes to stay away from if there are others
+        :param hedge: if the call is idempotent, let the pool's Hedger (if any) send it to a second node when slow
+        :param stream: fn streams the response body, so the request counts as outstanding until the response is
+            closed rather than until the headers arrive; the caller must close it
+        :returns: the response
+        """
+        if hedge and self.hedger is not None:
+            return self.hedger.call(self, fn, stream=stream)
+        tried = list(exclude)
+        while True:
+            node = self.acquire(exclude=tried)
+            try:
+                resp = fn(node)
+            except requests.ConnectionError:
+                self.release(node, ok=False)
+                tried.append(node)
+                if not retry or len(set(tried)) >= len(self.nodes):
+                    raise
+                with self._lock:
+                    self.retries += 1
+                continue
+            except requests.RequestException:
+                self.release(node, ok=False)
+                raise
+            except Exception:
+                self.release(node)
+                raise
+            if stream:
+                self._release_on_close(resp, node, resp.status_code < 500)
+            else:
+                self.release(node, ok=resp.status_code < 500)
+            return resp
+
+    def probe(self):
+        "Check every node once, ejecting the ones that are down and readmitting the ones that came back"
+        for node in self.nodes:
+            try:
+                alive = requests.get(node.url + self.probe_path, timeout=self.probe_timeout).status_code < 500
+            except requests.RequestException:
+                alive = False
+            with self._lock:
+                if alive and not node.healthy:
+                    self._readmit(node)
+                elif not alive and node.healthy:
+                    self._eject(node)
+
+    def _probe_forever(self):
+        while True:
+            time.sleep(self.probe_interval)
+            try:
+                self.probe()
+            except Exception:
+                LOG.exception("Fusion health probe failed")
+
+    def start_health_checks(self):
+        if self.probe_interval > 0 and self._prober is None:
+            self._prober = threading.Thread(target=self._probe_forever, name="fusion-health-probe")
+            self._prober.daemon = True
+            self._prober.start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "retries": self.retries,
+                "nodes": dict((node.url, {
+                    "healthy": node.healthy,
+                    "outstanding": node.outstanding,
+                    "requests": node.requests,
+                    "failures": node.failures,
+                    "ejections": node.ejections
+                }) for node in self.nodes)
+            }
+
+
+def fusion_node_urls():
+    "The base URLs of the Fusion API nodes, from FUSION_NODES or else FUSION_PROTOCOL/FUSION_HOST/FUSION_PORT"
+    nodes = app.config.get("FUSION_NODES")
+    if nodes:
+        return nodes
+    return ["{0}://{1}:{2}".format(app.config.get("FUSION_PROTOCOL", "http"),
+                                   app.config.get("FUSION_HOST"),
+                                   int(app.config.get("FUSION_PORT")))]
+
+
+def _new_node_pool():
+    pool = NodePool(fusion_node_urls(),
+                    max_failures=app.config.get("FUSION_NODE_MAX_FAILURES", 3),
+                    eject_seconds=app.config.get("FUSION_NODE_EJECT_SECONDS", 30),
+                    probe_path=app.config.get("FUSION_HEALTH_PATH", "/api"),
+                    probe_interval=app.config.get("FUSION_HEALTH_INTERVAL", 5),
+                    probe_timeout=app.config.get("FUSION_HEALTH_TIMEOUT", 2))
+    if len(pool) > 1:
+        pool.start_health_checks()
+    if app.config.get("HEDGING_ENABLED", False):
+        pool.hedger = Hedger(percentile=app.config.get("HEDGING_PERCENTILE", 95),
+                             min_delay=app.config.get("HEDGING_MIN_DELAY", 0.01),
+                             max_rate=app.config.get("HEDGING_MAX_RATE", 0.05),
+                             burst=app.config.get("HEDGING_BURST", 10),
+                             min_samples=app.config.get("HEDGING_MIN_SAMPLES", 100))
+    return pool
+
+
+def hedged(method, path):
+    "Whether a request may be hedged: only GETs under HEDGING_PREFIXES, i.e. searches"
+    if method != "GET" or not app.config.get("HEDGING_ENABLED", False):
+        return False
+    path = path.split("?", 1)[0]
+    return any(path.startswith(prefix) for prefix in app.config.get("HEDGING_PREFIXES", ["/api/apollo/query-pipelines/"]))
+
+
+_node_pool = PerProcess(_new_node_pool)
+
+
+def get_node_pool():
+    "The Fusion nodes for this worker process, shared by the proxy and the backend"
+    return _node_pool.get()
+
+
+def _node_pool_stats():
+    pool = _node_pool.peek()
+    if pool is not None:
+        return pool.stats()
+
+stats.register("fusion_nodes", _node_pool_stats)
+
+
+def _hedging_stats():
+    pool = _node_pool.peek()
+    if pool is not None and pool.hedger is not None:
+        return pool.hedger.stats()
+
+stats.register("hedging", _hedging_stats)
@@ -1,27 +1,333 @@
 import httplib
+import logging
 import re
-import urllib
+import threading
 import urlparse
 import json
 
 from flask import Flask, Blueprint, request, Response, url_for, stream_with_context
 from werkzeug.datastructures import Headers
 from werkzeug.exceptions import NotFound
-from server import app
-from base64 import b64encode
+from werkzeug.http import generate_etag, quote_etag
 import requests
+from server import app, jsoncodec, stats
+from server.admission import Admitted, Overloaded
+from server.breaker import CircuitOpen, get_breaker, get_last_good
+from server.cache import ResponseCache, CachedResponse, STALE, canonical_key, response_size
+from server.compression import accepts_gzip, should_compress, gzip_bytes, gzip_stream
+from server.lazy import PerProcess
+from server.shaping import ShapingRule, rule_for
+from server.singleflight import SingleFlight
+from server.upstream import get_upstream
 # Basics From https://github.com/ziozzang/flask-as-http-proxy-server/blob/master/proxy.py
 
+LOG = logging.getLogger("proxy.py")
+
 proxy = Blueprint('proxy', __name__)
 app.register_blueprint(proxy)
 # You can insert Authentication here.
 #proxy.before_request(check_login)
 
 
-def iterform(multidict):
-    for key in multidict.keys():
-        for value in multidict.getlist(key):
-            yield (key.encode("utf8"), value.encode("utf8"))
+# Request headers from the browser that we pass on to Fusion
+FORWARDED_REQUEST_HEADERS = ["Cookie", "Referer", "X-Csrf-Token", "Accept-Language", "Accept", "Accept-Encoding",
+                             "User-Agent", "Content-Type"]
+# Response headers from Fusion that we pass back to the browser
+FORWARDED_RESPONSE_HEADERS = ["Content-Type", "Content-Encoding", "Content-Length", "Cache-Control", "ETag",
+                              "Last-Modified", "Expires", "Vary"]
+CHUNK_SIZE = 8192
+# How we answer requests that are shed under load, by traffic class.  Anything not listed gets a 503.
+SHED_STATUS = {"suggest": 429}
+
+
+class RequestBody(object):
+    """
+    File-like wrapper around the incoming WSGI stream so that requests sends it to Fusion
+    as-is, with a Content-Length, without us reading it into memory first
+    """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+
+def request_body():
+    "The raw body of the current request, or None if it has none"
+    if request.method == "GET":
+        return None
+    if request.content_length is not None:
+        return RequestBody(request.stream, request.content_length)
+    # chunked upload, we have no choice but to read it
+    return request.get_data()
+
+
+def stream_upstream(r):
+    "Pass the upstream bytes through untouched (no gzip decoding) and always release the connection"
+    try:
+        for chunk in r.raw.stream(CHUNK_SIZE, decode_content=False):
+            yield chunk
+    finally:
+        r.close()
+
+
+def upstream_headers(r):
+    return [(h, r.headers[h]) for h in FORWARDED_RESPONSE_HEADERS if h in r.headers]
+
+
+def traffic_class(path):
+    "Which admission control class a call to Fusion for path belongs to"
+    if path.split("?", 1)[0].endswith("/suggest"):
+        return "suggest"
+    return "search"
+
+
+def compress_with_gzip(response_headers, accept_encoding):
+    "Whether the proxy should gzip a response itself for a client sending accept_encoding"
+    return (app.config.get("PROXY_GZIP_ENABLED", False) and accepts_gzip(accept_encoding)
+            and should_compress(response_headers, app.config.get("PROXY_GZIP_MIN_BYTES", 1024)))
+
+
+def set_gzipped(response_headers):
+    "Fix up the headers of a response we are gzipping"
+    response_headers.pop("Content-Length", None)
+    response_headers["Content-Encoding"] = "gzip"
+    vary = response_headers.get("Vary")
+    if not vary:
+        response_headers["Vary"] = "Accept-Encoding"
+    elif "accept-encoding" not in vary.lower():
+        response_headers["Vary"] = vary + ", Accept-Encoding"
+    # a strong validator names one exact representation, and the gzipped one is a different one
+    etag = response_headers.get("ETag")
+    if etag and not etag.startswith("W/") and etag.endswith('"'):
+        response_headers["ETag"] = etag[:-1] + '-gzip"'
+
+
+def validates(path):
+    "Whether GET responses for path get an ETag and a Cache-Control header from the proxy"
+    if not app.config.get("PROXY_ETAG_ENABLED", False):
+        return False
+    prefixes = app.config.get("PROXY_ETAG_PREFIXES", ["/api/apollo/query-pipelines/"])
+    path = path.split("?", 1)[0]
+    return any(path.startswith(prefix) for prefix in prefixes)
+
+
+def _new_shaping_rules():
+    return dict((prefix, ShapingRule(**settings))
+                for prefix, settings in app.config.get("PROXY_SHAPING_RULES", {}).items())
+
+
+_shaping_rules = PerProcess(_new_shaping_rules)
+
+
+def shaping_rule(path):
+    "The ShapingRule for the route path is on, or None"
+    return rule_for(_shaping_rules.get(), path.split("?", 1)[0])
+
+
+def shape_body(rule, body, path):
+    "Slim down a JSON Solr response body according to rule"
+    try:
+        decoded = jsoncodec.loads(body)
+    except ValueError:
+        return body
+    query_string = path.split("?", 1)[1] if "?" in path else ""
+    return jsoncodec.dumps(rule.shape(decoded, rule.aliases(query_string)))
+
+
+def fetch_buffered(path, request_headers):
+    """
+    GET path from Fusion and read the whole body, still encoded as Fusion sent it.  If Fusion
+    didn't compress it but the client takes gzip, it is compressed once here.  Responses on
+    routes with a ShapingRule are requested uncompressed, slimmed down and then compressed.
+    """
+    rule = shaping_rule(path)
+    upstream_request_headers = request_headers
+    if rule is not None:
+        upstream_request_headers = dict(request_headers)
+        upstream_request_headers["Accept-Encoding"] = "identity"
+    def fetch():
+        with Admitted(traffic_class(path)):
+            r = get_upstream().get(path, headers=upstream_request_headers, stream=True)
+            try:
+                return r, r.raw.read(decode_content=False)
+            finally:
+                r.close()
+
+    breaker = route_breaker(path)
+    if breaker is None:
+        r, body = fetch()
+    else:
+        r, body = breaker.call(fetch, is_failure=lambda result: result[0].status_code >= 500)
+    response_headers = Headers(upstream_headers(r))
+    if (rule is not None and r.status_code == 200 and not response_headers.get("Content-Encoding")
+            and response_headers.get("Content-Type", "").startswith(("application/json", "text/plain"))):
+        body = shape_body(rule, body, path)
+        response_headers["Content-Length"] = str(len(body))
+        response_headers.pop("ETag", None)
+    if compress_with_gzip(response_headers, request_headers.get("Accept-Encoding")):
+        body = gzip_bytes(body, app.config.get("PROXY_GZIP_LEVEL", 6))
+        set_gzipped(response_headers)
+    if r.status_code == 200 and "ETag" not in response_headers and validates(path):
+        response_headers["ETag"] = quote_etag(generate_etag(body))
+    return CachedResponse(r.status_code, list(response_headers.items()), body)
+
+
+def route_breaker(path):
+    """
+    The circuit breaker for path's route if path is under BREAKER_PREFIXES, else None.  The route is the longest
+    matching prefix rather than the path itself, as clients choose the paths and breakers are never dropped
+    """
+    api_path = path.split("?", 1)[0]
+    prefixes = [prefix for prefix in app.config.get("BREAKER_PREFIXES", ["/api/apollo/query-pipelines/"])
+                if api_path.startswith(prefix)]
+    if not prefixes:
+        return None
+    return get_breaker(max(prefixes, key=len))
+
+
+def stale_fallback(api_path):
+    """
+    The store of last good responses to serve while api_path's circuit is open, or None.  Only paths under
+    BREAKER_STALE_PREFIXES have one, as keeping responses to fall back on means buffering them instead of streaming
+    """
+    if not any(api_path.startswith(prefix) for prefix in app.config.get("BREAKER_STALE_PREFIXES", [])):
+        return None
+    if route_breaker(api_path) is None:
+        return None
+    return get_last_good()
+
+
+def stale_response(last_good, key):
+    "The last good response for key, marked as stale, or None"
+    value = last_good.get(key)
+    if value is None:
+        return None
+    flask_response = buffered_response(value)
+    flask_response.headers["Warning"] = '110 - "Response is Stale"'
+    return flask_response
+
+
+def conditional_response(flask_response, api_path):
+    "Answer If-None-Match/If-Modified-Since with a 304 when the validators match"
+    if request.method == "GET" and flask_response.status_code == 200:
+        if validates(api_path):
+            flask_response.headers["Cache-Control"] = app.config.get("PROXY_CACHE_CONTROL", "private, max-age=30")
+        flask_response.make_conditional(request)
+    return flask_response
+
+
+def buffered_response(value):
+    return Response(response=value.body, status=value.status, headers=Headers(value.headers))
+
+
+def _new_response_cache():
+    if not app.config.get("PROXY_CACHE_ENABLED", False):
+        return None
+    return ResponseCache(app.config.get("PROXY_CACHE_MAX_BYTES", 64 * 1024 * 1024),
+                         ttl_rules=app.config.get("PROXY_CACHE_TTL_RULES", {"/api/apollo/query-pipelines/": 60}),
+                         default_ttl=app.config.get("PROXY_CACHE_DEFAULT_TTL", 0),
+                         stale_seconds=app.config.get("PROXY_CACHE_STALE_SECONDS", 30))
+
+
+_response_cache = PerProcess(_new_response_cache)
+
+
+def get_response_cache():
+    "The proxy's response cache for this worker process, or None if caching is disabled"
+    return _response_cache.get()
+
+
+def _response_cache_stats():
+    cache = _response_cache.peek()
+    if cache is not None:
+        return cache.stats()
+
+stats.register("proxy_cache", _response_cache_stats)
+
+
+def _new_single_flight():
+    if not app.config.get("PROXY_COALESCE_ENABLED", False):
+        return None
+    return SingleFlight(wait_timeout=app.config.get("PROXY_COALESCE_TIMEOUT", 5.0),
+                        is_failure=lambda value: value.status >= 500)
+
+
+_single_flight = PerProcess(_new_single_flight)
+
+
+def get_single_flight(api_path):
+    "The request coalescer for this worker process if api_path should be coalesced, else None"
+    prefixes = app.config.get("PROXY_COALESCE_PREFIXES", ["/api/apollo/query-pipelines/"])
+    if not any(api_path.startswith(prefix) for prefix in prefixes):
+        return None
+    return _single_flight.get()
+
+
+def _single_flight_stats():
+    flight = _single_flight.peek()
+    if flight is not None:
+        return flight.stats()
+
+stats.register("proxy_coalescing", _single_flight_stats)
+
+
+def fetch_shared(flight, key, path, request_headers, cache=None, ttl=0):
+    """
+    fetch_buffered, sharing one upstream call (and one cache fill) between identical
+    concurrent requests when coalescing is on
+    """
+    def fetch():
+        value = fetch_buffered(path, request_headers)
+        if cache is not None and value.status == 200:
+            cache.put(key, value, ttl)
+        last_good = stale_fallback(path.split("?", 1)[0])
+        if last_good is not None and value.status == 200:
+            last_good.put(key, value, response_size(key, value))
+        return value
+
+    if flight is None:
+        return fetch()
+    return flight.do(key, fetch)
+
+
+def refresh_cache_entry(cache, key, ttl, path, request_headers):
+    try:
+        value = fetch_buffered(path, request_headers)
+        if value.status == 200:
+            cache.put(key, value, ttl)
+    except (requests.RequestException, Overloaded) as e:
+        LOG.warning("Unable to refresh %s: %s", path, e)
+    finally:
+        cache.end_refresh(key)
+
+
+def cached_proxy_request(cache, flight, key, ttl, path, request_headers):
+    """
+    Serve a GET from the response cache, going to Fusion on a miss.  Stale entries are
+    served as-is while a single background thread fetches a fresh copy.
+    """
+    value, state = cache.get(key)
+    if value is None:
+        value = fetch_shared(flight, key, path, request_headers, cache, ttl)
+    elif state == STALE and cache.start_refresh(key):
+        refresher = threading.Thread(target=refresh_cache_entry, args=(cache, key, ttl, path, dict(request_headers)))
+        refresher.daemon = True
+        refresher.start()
+    return buffered_response(value)
+
+
+def accepted_encoding():
+    "Collapse the browser's Accept-Encoding down to the one variant we ask Fusion for"
+    if accepts_gzip(request.headers.get("Accept-Encoding")):
+        return "gzip"
+    return "identity"
+
 
 def parse_host_port(h):
     """Parses strings in the form host[:port]"""
@@ -37,39 +343,76 @@ def parse_host_port(h):
 #@proxy.route('/proxy/<host>/<path:file>', methods=["GET", "POST", "PUT", "DELETE"])
 @app.route('/api/<path:other>', methods=["GET", "POST"])
 def proxy_request(other):
-    hostname = app.config.get("FUSION_HOST")
-    port = int(app.config.get("FUSION_PORT"))
-    protocol = app.config.get("FUSION_PROTOCOL", "http")
-
-    user = app.config.get("FUSION_APP_USER")
-    password = app.config.get("FUSION_APP_PASSWORD")
-
-    userAndPass = b64encode(user + ":" + password).decode("ascii")
-    request_headers = {'Authorization' : 'Basic %s' %  userAndPass}
-    for h in ["Cookie", "Referer", "X-Csrf-Token", "Accept-Language", "Accept", "User-Agent"]:
+    request_headers = {}
+    for h in FORWARDED_REQUEST_HEADERS:
         if h in request.headers:
           request_headers[h] = request.headers[h]
+    # We hand Fusion's bytes straight back, so don't let requests ask for an encoding the browser didn't
+    request_headers.setdefault("Accept-Encoding", "identity")
 
+    api_path = '/api/' + other
     if request.query_string:
-      path = "/api/%s?%s" % (other, request.query_string)
+      path = "%s?%s" % (api_path, request.query_string)
     else:
-      path = '/api/' + other
+      path = api_path
 
-    print request_headers
-    if request.method == "POST" or request.method == "PUT":
-        form_data = list(iterform(request.form))
-        form_data = urllib.urlencode(form_data)
-        request_headers["Content-Length"] = len(form_data)
-    else:
-        form_data = None
-    r = None
-    if request.method == "POST" or request.method == "PUT":
-        r = requests.post("{0}://{1}:{2}{3}".format(protocol, hostname, port, path), data=form_data, headers=request_headers)
-    else:
-        r = requests.get("{0}://{1}:{2}{3}".format(protocol, hostname, port, path), headers=request_headers)
-    flask_response = Response(response=r.iter_content(8192),
-                              status=r.status_code)
-    return flask_response
+    if request.method == "GET":
+        rule = shaping_rule(api_path)
+        if rule is not None:
+            path = "%s?%s" % (api_path, rule.rewrite_query(request.query_string))
+        cache = get_response_cache()
+        ttl = cache.ttl_for(api_path) if cache is not None else 0
+        flight = get_single_flight(api_path)
+        last_good = stale_fallback(api_path)
+        # We can only compute an ETag, reshape the response, or keep it to fall back on, once we have the whole body
+        if ttl > 0 or flight is not None or validates(api_path) or rule is not None or last_good is not None:
+            request_headers["Accept-Encoding"] = accepted_encoding()
+            key = canonical_key(api_path, request.query_string, request_headers["Accept-Encoding"])
+            try:
+                if ttl > 0:
+                    flask_response = cached_proxy_request(cache, flight, key, ttl, path, request_headers)
+                else:
+                    flask_response = buffered_response(fetch_shared(flight, key, path, request_headers))
+            except CircuitOpen:
+                flask_response = stale_response(last_good, key) if last_good is not None else None
+                if flask_response is None:
+                    raise
+            return conditional_response(flask_response, api_path)
+
+    slot = Admitted(traffic_class(api_path)).acquire()
+    try:
+        breaker = route_breaker(api_path)
+        send = lambda: get_upstream().request(request.method, path, data=request_body(), headers=request_headers,
+                                              stream=True)
+        if breaker is None:
+            r = send()
+        else:
+            r = breaker.call(send, is_failure=lambda resp: resp.status_code >= 500)
+    except Exception:
+        slot.release()
+        raise
+    response_headers = Headers(upstream_headers(r))
+    body = stream_upstream(r)
+    if compress_with_gzip(response_headers, request.headers.get("Accept-Encoding")):
+        body = gzip_stream(body, app.config.get("PROXY_GZIP_LEVEL", 6))
+        set_gzipped(response_headers)
+    flask_response = Response(response=body,
+                              status=r.status_code,
+                              headers=response_headers,
+                              direct_passthrough=True)
+    # If the client goes away before we've drained the body, the generator may never run to completion
+    flask_response.call_on_close(r.close)
+    flask_response.call_on_close(slot.release)
+    return conditional_response(flask_response, api_path)
+
+
+@app.errorhandler(Overloaded)
+def shed_request(e):
+    "Fail fast instead of queueing behind an overloaded Fusion"
+    return Response("Search is temporarily overloaded, please retry",
+                    status=SHED_STATUS.get(e.traffic_class, 503),
+                    headers={"Retry-After": "1"},
+                    mimetype="text/plain")
 
 
 
@@ -0,0 +1,152 @@
+import fnmatch
+import urllib
+import urlparse
+
+# Pseudo-fields that are always allowed through fl
+PSEUDO_FIELDS = set(["score", "[explain]", "[docid]", "[shard]"])
+
+
+def _split_alias(fl_entry):
+    "An fl entry's (alias, rest), e.g. (author, author_s) for author:author_s; the alias is None if there is none"
+    colon = fl_entry.find(":")
+    opening = min([i for i in (fl_entry.find("["), fl_entry.find("(")) if i >= 0] or [len(fl_entry)])
+    if colon < 0 or colon > opening:
+        return None, fl_entry
+    return fl_entry[:colon], fl_entry[colon + 1:]
+
+
+def _field_name(fl_entry):
+    "The stored field an fl entry refers to, e.g. author_s for author:author_s"
+    return _split_alias(fl_entry)[1]
+
+
+def _split_fl(value):
+    "Split an fl value on commas and spaces, except inside [...] transformers, (...) functions and quotes"
+    entries = []
+    current = []
+    depth = 0
+    quote = None
+    for c in value:
+        if quote is not None:
+            if c == quote:
+                quote = None
+        elif c in "'\"":
+            quote = c
+        elif c in "[(":
+            depth += 1
+        elif c in ")]":
+            depth = max(0, depth - 1)
+        elif c in ", " and depth == 0:
+            if current:
+                entries.append("".join(current))
+            current = []
+            continue
+        current.append(c)
+    if current:
+        entries.append("".join(current))
+    return entries
+
+
+def _fl_entries(params):
+    entries = []
+    for name, value in params:
+        if name == "fl":
+            entries.extend(_split_fl(value))
+    return entries
+
+
+def _computed(fl_entry):
+    "Whether an fl entry is a transformer such as [explain style=nl] or a function such as sum(a,b), not a field"
+    return "[" in fl_entry or "(" in fl_entry
+
+
+def _response_key(fl_entry):
+    "The key Solr returns an fl entry's value under, if that isn't the field's own name"
+    alias, rest = _split_alias(fl_entry)
+    if alias is not None:
+        return alias
+    if rest.startswith("["):
+        # transformers come back under their name alone, e.g. [explain] for [explain style=nl]
+        return "[" + rest[1:].split(" ", 1)[0].rstrip("]") + "]"
+    if _computed(rest):
+        return rest
+    return None
+
+
+class ShapingRule(object):
+    """
+    Slims down the Solr responses for one route.
+
+    fields is an allow-list of the stored fields the UI actually shows; the outgoing fl
+    is narrowed to it so that Fusion never serializes anything else, and anything else
+    that comes back anyway is dropped.  truncate maps text fields to the number of
+    characters to keep, and highlight_chars caps every highlighting snippet.
+    """
+
+    def __init__(self, fields=None, truncate=None, highlight_chars=None):
+        self.fields = set(fields) if fields else None
+        self.truncate = truncate or {}
+        self.highlight_chars = highlight_chars
+
+    def _allowed(self, name):
+        return self.fields is None or name in self.fields or name in PSEUDO_FIELDS
+
+    def rewrite_query(self, query_string):
+        "Narrow the fl parameter(s) of a query string to the allowed fields"
+        if self.fields is None:
+            return query_string
+        params = urlparse.parse_qsl(query_string or "", keep_blank_values=True)
+        fl = []
+        for entry in _fl_entries(params):
+            if ("*" in entry or "?" in entry) and not _computed(entry):
+                # a glob such as * or author* stands for the allowed fields it matches
+                fl.extend(name for name in sorted(fnmatch.filter(self.fields, entry)) if name not in fl)
+            elif (self._allowed(_field_name(entry)) or _computed(entry)) and entry not in fl:
+                fl.append(entry)
+        if not any(_field_name(entry) in self.fields for entry in fl):
+            # nothing asked for (or only pseudo-fields such as score) means every allowed field
+            fl = sorted(self.fields) + fl
+        params = [(name, value) for name, value in params if name != "fl"]
+        params.append(("fl", ",".join(fl)))
+        return urllib.urlencode(params)
+
+    def _cut(self, value, limit):
+        if isinstance(value, basestring):
+            return value[:limit]
+        if isinstance(value, list):
+            return [self._cut(v, limit) for v in value]
+        return value
+
+    def aliases(self, query_string):
+        "The response keys that a (rewritten) query string adds: aliases of allowed fields, transformers and functions"
+        params = urlparse.parse_qsl(query_string or "", keep_blank_values=True)
+        return set(key for key in map(_response_key, _fl_entries(params)) if key is not None)
+
+    def shape(self, decoded, aliases=()):
+        """
+        Apply the rule in place to a decoded Solr JSON response, and return it
+
+        :param decoded: the response
+        :param aliases: response keys to keep in addition to the allowed fields, see aliases()
+        """
+        docs = decoded.get("response", {}).get("docs", [])
+        for doc in docs:
+            for name in doc.keys():
+                if not (self._allowed(name) or name in aliases):
+                    del doc[name]
+                elif name in self.truncate:
+                    doc[name] = self._cut(doc[name], self.truncate[name])
+        if self.highlight_chars is not None:
+            for fragments in decoded.get("highlighting", {}).values():
+                for name in fragments:
+                    fragments[name] = self._cut(fragments[name], self.highlight_chars)
+        return decoded
+
+
+def rule_for(rules, path):
+    "The ShapingRule with the longest prefix of path, or None"
+    best = None
+    for prefix, rule in rules.items():
+        if path.startswith(prefix) and (best is None or len(prefix) > len(best[0])):
+            best = (prefix, rule)
+    return best[1] if best else None
@@ -0,0 +1,225 @@
+import atexit
+import logging
+import os
+
+from server import app, backend, stats
+from server.admission import Admitted, Overloaded
+from server.backends import SignalsRejected
+from server.lazy import PerProcess
+from server.backends.fusion import SIGNAL_COUNT_KEY, snowplow_to_signal, tracker_param
+from server.signals.aggregate import SignalAggregator
+from server.signals.batcher import SignalBatcher
+from server.signals.filter import DEFAULT_BOT_PATTERNS, SignalFilter
+from server.signals.spool import SignalSpool
+
+LOG = logging.getLogger("signals")
+
+
+def send_now(collection_id, payloads):
+    """
+    Send signals to Fusion from the calling thread, unless admission control sheds them
+
+    :raises SignalsRejected: if Fusion refused them as invalid
+    """
+    try:
+        with Admitted("signals"):
+            # a signal's count can only be given through the bulk API, not as a Snowplow tracker param
+            if len(payloads) == 1 and SIGNAL_COUNT_KEY not in payloads[0]:
+                return backend.send_signal(collection_id, payloads[0])
+            return backend.send_signals(collection_id, payloads)
+    except Overloaded:
+        # Signals are the first thing we drop when Fusion is struggling
+        LOG.debug("Dropped %d signals for %s", len(payloads), collection_id)
+        return False
+
+
+def _new_batcher():
+    if not app.config.get("SIGNAL_BATCHING_ENABLED", False):
+        return None
+    batcher = SignalBatcher(send_now,
+                            max_queue=app.config.get("SIGNAL_QUEUE_SIZE", 10000),
+                            batch_size=app.config.get("SIGNAL_BATCH_SIZE", 100),
+                            flush_interval=app.config.get("SIGNAL_FLUSH_INTERVAL", 1.0))
+    return batcher.start()
+
+
+_batcher = PerProcess(_new_batcher)
+
+
+def _batcher_stats():
+    batcher = _batcher.peek()
+    if batcher is not None:
+        return batcher.stats()
+
+stats.register("signal_queue", _batcher_stats)
+
+
+def _new_spool():
+    if not app.config.get("SIGNAL_SPOOL_ENABLED", False):
+        return None
+    default_dir = os.path.join(app.config.get("BASE_DIR", os.getcwd()), "signal_spool")
+    spool = SignalSpool(app.config.get("SIGNAL_SPOOL_DIR", default_dir),
+                        send_now,
+                        segment_bytes=app.config.get("SIGNAL_SPOOL_SEGMENT_BYTES", 4 * 1024 * 1024),
+                        max_bytes=app.config.get("SIGNAL_SPOOL_MAX_BYTES", 256 * 1024 * 1024),
+                        fsync=app.config.get("SIGNAL_SPOOL_FSYNC", "interval"),
+                        fsync_interval=app.config.get("SIGNAL_SPOOL_FSYNC_INTERVAL", 1.0),
+                        batch_size=app.config.get("SIGNAL_BATCH_SIZE", 100),
+                        max_backoff=app.config.get("SIGNAL_SPOOL_MAX_BACKOFF", 60))
+    return spool.start()
+
+
+_spool = PerProcess(_new_spool)
+
+
+def _spool_stats():
+    spool = _spool.peek()
+    if spool is not None:
+        return spool.stats()
+
+stats.register("signal_spool", _spool_stats)
+
+
+def signal_key(collection_id, payload):
+    "What makes two signals interchangeable for aggregation: (collection, type, doc id, query, project)"
+    signal = snowplow_to_signal(payload)
+    if signal is None:
+        # malformed, let it through on its own
+        return None
+    if signal["type"] not in app.config.get("SIGNAL_AGGREGATE_TYPES", ["click", "search"]):
+        return None
+    params = signal["params"]
+    query = params.get("query")
+    if query is None and isinstance(params.get("terms"), list):
+        # trackSiteSearch sends the query as a list of terms
+        query = " ".join(params["terms"])
+    key = collection_id, signal["type"], params.get("docId"), query, params.get("project")
+    # parameters sent more than once come as lists, which can't be hashed
+    return tuple(tuple(part) if isinstance(part, list) else part for part in key)
+
+
+def _new_aggregator():
+    if not app.config.get("SIGNAL_AGGREGATION_ENABLED", False):
+        return None
+    aggregator = SignalAggregator(deliver, signal_key, count_key=SIGNAL_COUNT_KEY,
+                                  window_seconds=app.config.get("SIGNAL_AGGREGATION_WINDOW", 60),
+                                  max_keys=app.config.get("SIGNAL_AGGREGATION_MAX_KEYS", 100000))
+    return aggregator.start()
+
+
+_aggregator = PerProcess(_new_aggregator)
+
+
+def _aggregator_stats():
+    aggregator = _aggregator.peek()
+    if aggregator is not None:
+        return aggregator.stats()
+
+stats.register("signal_aggregation", _aggregator_stats)
+
+
+def _new_filter():
+    if not app.config.get("SIGNAL_FILTER_ENABLED", False):
+        return None
+    return SignalFilter(rate_limit=app.config.get("SIGNAL_FILTER_RATE_LIMIT", 120),
+                        rate_window=app.config.get("SIGNAL_FILTER_RATE_WINDOW", 60),
+                        sketch_width=app.config.get("SIGNAL_FILTER_SKETCH_WIDTH", 2048),
+                        sketch_depth=app.config.get("SIGNAL_FILTER_SKETCH_DEPTH", 4),
+                        dedupe_capacity=app.config.get("SIGNAL_FILTER_DEDUPE_CAPACITY", 100000),
+                        dedupe_error_rate=app.config.get("SIGNAL_FILTER_DEDUPE_ERROR_RATE", 0.001),
+                        dedupe_window=app.config.get("SIGNAL_FILTER_DEDUPE_WINDOW", 600),
+                        bot_patterns=app.config.get("SIGNAL_FILTER_BOT_PATTERNS", DEFAULT_BOT_PATTERNS))
+
+
+_filter = PerProcess(_new_filter)
+
+
+def _filter_stats():
+    signal_filter = _filter.peek()
+    if signal_filter is not None:
+        return signal_filter.stats()
+
+stats.register("signal_filter", _filter_stats)
+
+
+def tracker_payload(args):
+    "A request's Snowplow tracker parameters as a plain dict, with a list of values for any sent more than once"
+    return dict((key, values[0] if len(values) == 1 else values) for key, values in args.to_dict(flat=False).items())
+
+
+def client_address(remote_addr, forwarded_for):
+    """
+    The address of the client behind a request, for the signal filter's rate limit
+
+    Behind SIGNAL_FILTER_PROXY_HOPS reverse proxies remote_addr is the nearest proxy's, and the client's is that
+    many entries from the end of X-Forwarded-For; entries further left were sent by the client and can be forged.
+
+    :param remote_addr: the address the request came from
+    :param forwarded_for: the request's X-Forwarded-For headers, a list
+    """
+    hops = app.config.get("SIGNAL_FILTER_PROXY_HOPS", 0)
+    entries = [entry.strip() for header in forwarded_for for entry in header.split(",") if entry.strip()]
+    if not hops or not entries:
+        return remote_addr
+    return entries[max(0, len(entries) - hops)]
+
+
+def accept_signal(client, payload, user_agent):
+    """
+    Whether a signal looks like it came from a real visitor, the first time it was sent
+
+    :param client: the sender's address
+    :param payload: the Snowplow tracker parameters, see tracker_payload
+    :param user_agent: the sender's User-Agent header
+    """
+    signal_filter = _filter.get()
+    if signal_filter is None:
+        return True
+    # eid is the tracker's unique id for the event, the same on every retry of it
+    reason = signal_filter.check(client, tracker_param(payload, "eid"), user_agent)
+    if reason is not None:
+        LOG.debug("Dropped signal from %s: %s", client, reason)
+        return False
+    return True
+
+
+def deliver(collection_id, payload):
+    """
+    Pass a signal on towards Fusion.  With the spool on this only writes it to local disk, with batching
+    on it only queues it in memory, otherwise it is sent right away.
+    """
+    spool = _spool.get()
+    if spool is not None:
+        return spool.append(collection_id, payload)
+    batcher = _batcher.get()
+    if batcher is None:
+        try:
+            return send_now(collection_id, [payload])
+        except SignalsRejected as e:
+            LOG.debug("Fusion rejected a signal for %s: %s", collection_id, e)
+            return False
+    return batcher.offer(collection_id, payload)
+
+
+@atexit.register
+def _shutdown():
+    "Push whatever this process is still holding in memory towards Fusion, in pipeline order"
+    aggregator = _aggregator.peek()
+    if aggregator is not None:
+        aggregator.flush()
+    batcher = _batcher.peek()
+    if batcher is not None:
+        batcher.drain()
+
+
+def record_signal(collection_id, payload):
+    """
+    Hand a signal off to Fusion, counting it into the current aggregation window if aggregation is on
+
+    :param collection_id: the collection the signal is for
+    :param payload: the Snowplow tracker parameters, see tracker_payload
+    """
+    aggregator = _aggregator.get()
+    if aggregator is not None and aggregator.add(collection_id, payload):
+        return True
+    return deliver(collection_id, payload)
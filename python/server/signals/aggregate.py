@@ -0,0 +1,93 @@
+import logging
+import threading
+import time
+
+LOG = logging.getLogger("aggregate.py")
+
+
+class SignalAggregator(object):
+    """
+    Combines repeated signals over tumbling windows.
+
+    Signals with the same key (see key_fn) that arrive in the same window_seconds window
+    are counted instead of being sent one by one.  When the window closes, one signal per
+    key is emitted: the first one seen, with its count_key set to the number of signals it
+    stands for.  A window holds at most max_keys keys; signals for new keys beyond that,
+    and signals key_fn returns None for, are not aggregated.
+    """
+
+    def __init__(self, emit, key_fn, count_key="count", window_seconds=60, max_keys=100000):
+        """
+        :param emit: callable(collection_id, payload) that passes a combined signal on
+        :param key_fn: callable(collection_id, payload) returning a hashable key, or None to not aggregate
+        :param count_key: the payload key to put the count under
+        """
+        self.emit = emit
+        self.key_fn = key_fn
+        self.count_key = count_key
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        self._window = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.aggregated = 0
+        self.passed_through = 0
+        self.emitted = 0
+        self.windows = 0
+
+    def add(self, collection_id, payload):
+        """
+        Count a signal in the current window
+
+        :returns: True if the signal was absorbed, False if the caller should send it on its own
+        """
+        key = self.key_fn(collection_id, payload)
+        with self._lock:
+            if key is None or (key not in self._window and len(self._window) >= self.max_keys):
+                self.passed_through += 1
+                return False
+            entry = self._window.get(key)
+            if entry is None:
+                self._window[key] = [collection_id, payload, 1]
+            else:
+                entry[2] += 1
+            self.aggregated += 1
+            return True
+
+    def flush(self):
+        "Close the current window and emit one weighted signal per key"
+        with self._lock:
+            window, self._window = self._window, {}
+            self.windows += 1
+        for collection_id, payload, count in window.values():
+            weighted = dict(payload)
+            weighted[self.count_key] = count
+            try:
+                self.emit(collection_id, weighted)
+            except Exception:
+                LOG.exception("Unable to emit aggregated signal")
+        with self._lock:
+            self.emitted += len(window)
+
+    def _run(self):
+        while True:
+            # line windows up with the clock so that every process closes them at the same time
+            time.sleep(self.window_seconds - time.time() % self.window_seconds)
+            self.flush()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="signal-aggregator")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stats(self):
+        with self._lock:
+            return {
+                "open_keys": len(self._window),
+                "aggregated": self.aggregated,
+                "passed_through": self.passed_through,
+                "emitted": self.emitted,
+                "windows": self.windows
+            }
@@ -0,0 +1,111 @@
+import logging
+import Queue
+import threading
+import time
+
+LOG = logging.getLogger("batcher.py")
+
+
+class SignalBatcher(object):
+    """
+    Bounded in-memory queue of signals with a background thread that sends them in batches.
+
+    offer() never blocks: when the queue is full the signal is dropped and counted.  The
+    flusher sends whatever has accumulated once it has batch_size signals or the oldest
+    one has waited flush_interval seconds, one call per collection.
+    """
+
+    def __init__(self, send, max_queue=10000, batch_size=100, flush_interval=1.0):
+        """
+        :param send: callable(collection_id, payloads) that sends a batch and returns True on success
+        """
+        self.send = send
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = Queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self.enqueued = 0
+        self.dropped = 0
+        self.batches = 0
+        self.flushed = 0
+        self.failed = 0
+
+    def offer(self, collection_id, payload):
+        "Queue a signal, returning False if it had to be dropped"
+        try:
+            self._queue.put_nowait((collection_id, payload))
+        except Queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="signal-batcher")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def _next_batch(self):
+        "Block for the first signal, then gather more until the batch is full or flush_interval is up"
+        batch = [self._queue.get()]
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0 or self._stopping:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            self.flush(self._next_batch())
+
+    def flush(self, batch):
+        "Send a list of (collection_id, payload) tuples, one call per collection"
+        by_collection = {}
+        for collection_id, payload in batch:
+            by_collection.setdefault(collection_id, []).append(payload)
+        for collection_id, payloads in by_collection.items():
+            try:
+                ok = self.send(collection_id, payloads)
+            except Exception:
+                LOG.exception("Unable to send %d signals", len(payloads))
+                ok = False
+            with self._lock:
+                self.batches += 1
+                if ok:
+                    self.flushed += len(payloads)
+                else:
+                    self.failed += len(payloads)
+
+    def drain(self):
+        "Send everything still queued, from the calling thread (e.g. at shutdown)"
+        self._stopping = True
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        if batch:
+            self.flush(batch)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "enqueued": self.enqueued,
+                "dropped": self.dropped,
+                "batches": self.batches,
+                "flushed": self.flushed,
+                "failed": self.failed
+            }
@@ -0,0 +1,142 @@
+import hashlib
+import math
+import re
+import struct
+import threading
+import time
+from array import array
+
+DEFAULT_BOT_PATTERNS = ["bot", "crawl", "spider", "slurp", "curl", "wget", "python-requests", "headless", "phantomjs"]
+
+
+def _hashes(key, count, size):
+    "count bucket indexes in [0, size) for key, by double hashing one md5"
+    if isinstance(key, unicode):
+        key = key.encode("utf8")
+    h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+    return [(h1 + i * h2) % size for i in range(count)]
+
+
+class CountMinSketch(object):
+    "Approximate counts of keys in fixed memory.  Estimates never undercount"
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array("L", [0]) * width for i in range(depth)]
+
+    def add(self, key, count=1):
+        "Count key and return its new estimated count"
+        estimate = None
+        for row, index in zip(self.rows, _hashes(key, self.depth, self.width)):
+            row[index] += count
+            estimate = row[index] if estimate is None else min(estimate, row[index])
+        return estimate
+
+    def clear(self):
+        for row in self.rows:
+            for i in range(self.width):
+                row[i] = 0
+
+
+class BloomFilter(object):
+    "Set membership in fixed memory, with false positives at about error_rate once capacity keys are in it"
+
+    def __init__(self, capacity=100000, error_rate=0.001):
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def __contains__(self, key):
+        return all(self.bits[i >> 3] & (1 << (i & 7)) for i in _hashes(key, self.hash_count, self.size))
+
+    def add(self, key):
+        for i in _hashes(key, self.hash_count, self.size):
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+
+class RotatingBloomFilter(object):
+    """
+    Remembers keys for between one and two rotation periods, in fixed memory, by keeping
+    a current and a previous BloomFilter and dropping the previous one on every rotation
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = BloomFilter(capacity, error_rate)
+
+    def rotate(self):
+        self.previous, self.current = self.current, BloomFilter(self.capacity, self.error_rate)
+
+    def __contains__(self, key):
+        return key in self.current or key in self.previous
+
+    def add(self, key):
+        self.current.add(key)
+
+
+class SignalFilter(object):
+    """
+    Drops signals from bots, duplicate deliveries of the same event and clients sending too
+    many events, using structures whose size is fixed up front rather than growing with
+    traffic: a count-min sketch of events per client per rate_window seconds, and a
+    rotating Bloom filter of the event ids seen in the last dedupe_window seconds or so.
+    """
+
+    def __init__(self, rate_limit=120, rate_window=60, sketch_width=2048, sketch_depth=4,
+                 dedupe_capacity=100000, dedupe_error_rate=0.001, dedupe_window=600, bot_patterns=None):
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.dedupe_window = dedupe_window
+        self.sketch = CountMinSketch(sketch_width, sketch_depth)
+        self.seen = RotatingBloomFilter(dedupe_capacity, dedupe_error_rate)
+        self.bots = re.compile("|".join(bot_patterns), re.IGNORECASE) if bot_patterns else None
+        self._lock = threading.Lock()
+        now = time.time()
+        self._window_ends = now + rate_window
+        self._rotate_at = now + dedupe_window
+        self.accepted = 0
+        self.dropped = {"bot": 0, "duplicate": 0, "rate_limited": 0}
+
+    def check(self, client, event_id, user_agent):
+        """
+        Decide whether to keep a signal
+
+        :param client: identifies the sender, e.g. its IP address
+        :param event_id: the tracker's unique id for the event, if any
+        :param user_agent: the sender's User-Agent header
+        :returns: None to keep it, otherwise why it was dropped
+        """
+        if self.bots is not None and (not user_agent or self.bots.search(user_agent)):
+            reason = "bot"
+        else:
+            with self._lock:
+                now = time.time()
+                if now >= self._window_ends:
+                    self.sketch.clear()
+                    self._window_ends = now + self.rate_window
+                if now >= self._rotate_at:
+                    self.seen.rotate()
+                    self._rotate_at = now + self.dedupe_window
+                if event_id and event_id in self.seen:
+                    reason = "duplicate"
+                elif client and self.sketch.add(client) > self.rate_limit:
+                    reason = "rate_limited"
+                else:
+                    # only accepted events count as seen, so that a retry of a dropped one still gets through
+                    if event_id:
+                        self.seen.add(event_id)
+                    self.accepted += 1
+                    return None
+        with self._lock:
+            self.dropped[reason] += 1
+        return reason
+
+    def stats(self):
+        with self._lock:
+            result = {"accepted": self.accepted}
+            for reason, count in self.dropped.items():
+                result["dropped_" + reason] = count
+            return result
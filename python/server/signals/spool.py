@@ -0,0 +1,382 @@
+import errno
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from server.backends import SignalsRejected
+
+LOG = logging.getLogger("spool.py")
+
+SEGMENT_SUFFIX = ".log"
+CHECKPOINT = "checkpoint"
+LOCK = "lock"
+DEAD_LETTERS = "dead-letters.jsonl"
+
+
+class SpoolDirectory(object):
+    """
+    One directory of append-only, numbered segment files of JSON lines plus a checkpoint
+    of how far the replayer got.  Each worker process writes to its own directory, and
+    holds an exclusive lock on it for as long as it lives.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock_file = open(os.path.join(path, LOCK), "a")
+        self._lock = threading.Lock()
+        self._writer = None
+        self._writer_seq = None
+        self._writer_bytes = 0
+        self._last_fsync = 0
+        self.checkpoint = self._read_checkpoint()
+        self.oldest_unsent = None
+
+    def try_lock(self):
+        "Take the directory's lock without blocking.  Fails if a live process owns it"
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        self._lock_file.close()
+
+    def _segment_path(self, seq):
+        return os.path.join(self.path, "%020d%s" % (seq, SEGMENT_SUFFIX))
+
+    def segments(self):
+        "The sequence numbers of the segments in this directory, oldest first"
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def size(self):
+        total = 0
+        for seq in self.segments():
+            try:
+                total += os.path.getsize(self._segment_path(seq))
+            except OSError:
+                pass
+        return total
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self.path, CHECKPOINT)) as f:
+                seq, offset = f.read().split()
+                return int(seq), int(offset)
+        except (IOError, ValueError):
+            return 0, 0
+
+    def _write_checkpoint(self, position):
+        tmp = os.path.join(self.path, CHECKPOINT + ".tmp")
+        with open(tmp, "w") as f:
+            f.write("%d %d" % position)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, os.path.join(self.path, CHECKPOINT))
+
+    def append(self, line, segment_bytes, fsync, fsync_interval):
+        """
+        Append one record to the current segment, starting a new segment once it reaches segment_bytes
+
+        :param fsync: "always" to fsync every record, "interval" to fsync at most every fsync_interval
+            seconds, anything else to leave it to the OS
+        :returns: the number of bytes written
+        """
+        with self._lock:
+            if self._writer is None or self._writer_bytes >= segment_bytes:
+                if self._writer is not None:
+                    self._writer.close()
+                existing = self.segments()
+                self._writer_seq = (existing[-1] + 1) if existing else max(self.checkpoint[0], 1)
+                self._writer = open(self._segment_path(self._writer_seq), "ab")
+                self._writer_bytes = 0
+            self._writer.write(line)
+            self._writer.flush()
+            self._writer_bytes += len(line)
+            now = time.time()
+            if fsync == "always" or (fsync == "interval" and now - self._last_fsync >= fsync_interval):
+                os.fsync(self._writer.fileno())
+                self._last_fsync = now
+            return len(line)
+
+    def sync(self):
+        with self._lock:
+            if self._writer is not None:
+                os.fsync(self._writer.fileno())
+                self._last_fsync = time.time()
+
+    def drop_oldest(self):
+        """
+        Delete the oldest segment that isn't being written to, to make room
+
+        :returns: the number of bytes freed
+        """
+        with self._lock:
+            for seq in self.segments():
+                if seq == self._writer_seq:
+                    break
+                segment = self._segment_path(seq)
+                size = os.path.getsize(segment)
+                os.remove(segment)
+                if self.checkpoint[0] <= seq:
+                    self.checkpoint = (seq + 1, 0)
+                    self._write_checkpoint(self.checkpoint)
+                return size
+        return 0
+
+    def read_batch(self, max_records):
+        """
+        Read up to max_records unsent records starting at the checkpoint
+
+        :returns: a list of (record, position) tuples, position being just past the record; commit(position)
+            once the records up to it are sent
+        """
+        with self._lock:
+            seq, offset = self.checkpoint
+            segments = [s for s in self.segments() if s >= seq]
+        records = []
+        for segment_seq in segments:
+            if segment_seq != seq:
+                seq, offset = segment_seq, 0
+            try:
+                with open(self._segment_path(seq), "rb") as f:
+                    f.seek(offset)
+                    for line in f:
+                        if not line.endswith("\n"):
+                            break  # still being written
+                        offset += len(line)
+                        try:
+                            records.append((json.loads(line), (seq, offset)))
+                        except ValueError:
+                            LOG.warning("Skipping corrupt signal record in %s", self._segment_path(seq))
+                        if len(records) >= max_records:
+                            break
+            except IOError:
+                # dropped to make room while we were reading it
+                continue
+            if len(records) >= max_records:
+                break
+        self.oldest_unsent = records[0][0].get("t") if records else None
+        return records
+
+    def commit(self, position):
+        "Record that everything before position was sent and delete the segments that are done"
+        with self._lock:
+            self.checkpoint = position
+            self._write_checkpoint(position)
+            for seq in self.segments():
+                if seq >= position[0]:
+                    break
+                try:
+                    os.remove(self._segment_path(seq))
+                except OSError:
+                    pass
+
+
+class SignalSpool(object):
+    """
+    Durable write-ahead spool of signals on local disk.
+
+    append() only writes a line to a local file, so recording a signal costs microseconds
+    whether or not Fusion is up.  A background replayer sends what was spooled to Fusion
+    in batches, checkpointing after each collection's part of a batch and backing off while
+    Fusion is failing.  Signals that Fusion rejects as invalid are narrowed down by halving
+    the batch and set aside in a dead letter file under root instead of being retried.
+    Spool directories left behind by processes that died (or by a previous run) are
+    adopted and drained too, so signals survive restarts.  Each process' spool is capped
+    at max_bytes by dropping its oldest segments.
+    """
+
+    def __init__(self, root, send, segment_bytes=4 * 1024 * 1024, max_bytes=256 * 1024 * 1024, fsync="interval",
+                 fsync_interval=1.0, batch_size=100, poll_interval=0.5, max_backoff=60):
+        """
+        :param send: callable(collection_id, payloads) that sends a batch and returns True on success, raising
+            SignalsRejected if they are invalid
+        """
+        self.root = root
+        self.send = send
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.own = SpoolDirectory(os.path.join(root, str(os.getpid())))
+        self.own.try_lock()
+        self.adopted = []
+        self._bytes = self.own.size()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.appended = 0
+        self.replayed = 0
+        self.failures = 0
+        self.dead_lettered = 0
+        self.dropped_bytes = 0
+        self.backoff = 0
+
+    def append(self, collection_id, payload):
+        line = json.dumps({"c": collection_id, "p": payload, "t": time.time()}, separators=(",", ":")) + "\n"
+        written = self.own.append(line, self.segment_bytes, self.fsync, self.fsync_interval)
+        with self._lock:
+            self.appended += 1
+            self._bytes += written
+            over = self._bytes > self.max_bytes
+        while over:
+            freed = self.own.drop_oldest()
+            if not freed:
+                break
+            LOG.warning("Signal spool is full, dropped %d bytes of unsent signals", freed)
+            with self._lock:
+                self._bytes -= freed
+                self.dropped_bytes += freed
+                over = self._bytes > self.max_bytes
+        return True
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="signal-spool-replayer")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def adopt_orphans(self):
+        "Take over the spool directories of processes that are no longer running"
+        adopted_paths = set(d.path for d in self.adopted)
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if path == self.own.path or path in adopted_paths or not os.path.isdir(path):
+                continue
+            orphan = SpoolDirectory(path)
+            if orphan.try_lock():
+                LOG.info("Replaying signals left in %s", path)
+                self.adopted.append(orphan)
+            else:
+                orphan.close()
+
+    def _dead_letter(self, record):
+        LOG.warning("Fusion rejected a signal for %s, setting it aside", record["c"])
+        with open(os.path.join(self.root, DEAD_LETTERS), "ab") as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        with self._lock:
+            self.dead_lettered += 1
+
+    def _send_run(self, spool_dir, collection_id, entries):
+        """
+        Send (record, position) entries for one collection and commit them
+
+        :returns: False if they couldn't be sent and should be retried later
+        """
+        try:
+            ok = self.send(collection_id, [record["p"] for record, position in entries])
+        except SignalsRejected:
+            if len(entries) > 1:
+                middle = len(entries) // 2
+                return (self._send_run(spool_dir, collection_id, entries[:middle]) and
+                        self._send_run(spool_dir, collection_id, entries[middle:]))
+            self._dead_letter(entries[0][0])
+            spool_dir.commit(entries[0][1])
+            return True
+        except Exception:
+            LOG.exception("Unable to replay %d signals", len(entries))
+            ok = False
+        if not ok:
+            return False
+        spool_dir.commit(entries[-1][1])
+        with self._lock:
+            self.replayed += len(entries)
+        return True
+
+    def _send(self, spool_dir, entries):
+        "Send entries in order, one call per run of records for the same collection"
+        start = 0
+        while start < len(entries):
+            end = start + 1
+            while end < len(entries) and entries[end][0]["c"] == entries[start][0]["c"]:
+                end += 1
+            if not self._send_run(spool_dir, entries[start][0]["c"], entries[start:end]):
+                return False
+            start = end
+        return True
+
+    def replay_once(self):
+        """
+        Send one batch from each spool directory
+
+        :returns: True if anything was sent, False if there was nothing to do, None if sending failed
+        """
+        sent = False
+        for spool_dir in [self.own] + self.adopted:
+            entries = spool_dir.read_batch(self.batch_size)
+            if not entries:
+                if spool_dir is not self.own:
+                    # an adopted directory nobody writes to any more, we're done with it
+                    self.adopted.remove(spool_dir)
+                    spool_dir.close()
+                    shutil.rmtree(spool_dir.path, ignore_errors=True)
+                continue
+            if not self._send(spool_dir, entries):
+                with self._lock:
+                    self.failures += 1
+                return None
+            sent = True
+        with self._lock:
+            self._bytes = self.own.size()
+        return sent
+
+    def _run(self):
+        self.adopt_orphans()
+        last_scan = time.time()
+        while True:
+            try:
+                result = self.replay_once()
+            except Exception:
+                LOG.exception("Signal replay failed")
+                result = None
+            if result is None:
+                self.backoff = min(max(self.backoff * 2, self.poll_interval), self.max_backoff)
+                time.sleep(self.backoff)
+                continue
+            self.backoff = 0
+            if not result:
+                if self.fsync == "interval":
+                    self.own.sync()
+                time.sleep(self.poll_interval)
+            if time.time() - last_scan > 60:
+                self.adopt_orphans()
+                last_scan = time.time()
+
+    def oldest_unsent_age(self):
+        "Seconds since the oldest signal still waiting to be sent was spooled"
+        stamps = [d.oldest_unsent for d in [self.own] + self.adopted if d.oldest_unsent is not None]
+        if not stamps:
+            return 0
+        return time.time() - min(stamps)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "adopted_directories": len(self.adopted),
+                "appended": self.appended,
+                "replayed": self.replayed,
+                "failures": self.failures,
+                "dead_lettered": self.dead_lettered,
+                "dropped_bytes": self.dropped_bytes,
+                "backoff_seconds": self.backoff,
+                "oldest_unsent_age_seconds": self.oldest_unsent_age()
+            }
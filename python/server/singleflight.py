@@ -0,0 +1,81 @@
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+
+class SingleFlight(object):
+    """
+    Collapse identical concurrent calls into one.
+
+    The first caller for a key (the leader) runs the function; callers that arrive
+    while it is running wait up to wait_timeout seconds and share its result.  If
+    the leader raises, returns a result that is_failure says is bad, or takes too
+    long, the waiting callers run the function themselves instead.
+    """
+
+    def __init__(self, wait_timeout=5.0, is_failure=None):
+        self.wait_timeout = wait_timeout
+        self.is_failure = is_failure
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.shared = 0
+        self.timeouts = 0
+        self.fallbacks = 0
+
+    def do(self, key, fn):
+        """
+        Run fn, or wait for and share the result of an identical call already in flight
+
+        :param key: identifies calls that are interchangeable
+        :param fn: a no-arg callable doing the actual work
+        :returns: the result of fn
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+
+        if leader:
+            try:
+                call.result = fn()
+                if self.is_failure is not None and self.is_failure(call.result):
+                    call.failed = True
+                return call.result
+            except Exception:
+                call.failed = True
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if not call.done.wait(self.wait_timeout):
+            with self._lock:
+                self.timeouts += 1
+            return fn()
+        if call.failed:
+            with self._lock:
+                self.fallbacks += 1
+            return fn()
+        with self._lock:
+            self.shared += 1
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "leaders": self.leaders,
+                "shared": self.shared,
+                "timeouts": self.timeouts,
+                "fallbacks": self.fallbacks
+            }
@@ -0,0 +1,80 @@
+import logging
+import mimetypes
+import os
+
+from flask import Response
+from werkzeug.http import generate_etag
+from server.compression import COMPRESSIBLE_TYPES, accepts_gzip, gzip_bytes
+
+LOG = logging.getLogger("static.py")
+
+
+class StaticAsset(object):
+    """
+    One file's bytes held in memory with everything needed to serve it precomputed: its
+    ETag, last modification time and, for text, a gzipped copy.  Nothing here changes
+    after it is built, so one instance can be shared by every thread (and across forks).
+    """
+
+    def __init__(self, body, content_type, cache_control, last_modified=None, gzip_min_bytes=256):
+        self.body = body
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.last_modified = last_modified
+        self.etag = generate_etag(body)
+        self.gzipped = None
+        if content_type.startswith(COMPRESSIBLE_TYPES) and len(body) >= gzip_min_bytes:
+            gzipped = gzip_bytes(body, 9)
+            if len(gzipped) < len(body):
+                self.gzipped = gzipped
+
+    def size(self):
+        return len(self.body) + len(self.gzipped or "")
+
+    def response(self, request):
+        "A response for request, gzipped if the client takes it, or a 304 if its validators match"
+        body, etag = self.body, self.etag
+        response = Response(content_type=self.content_type)
+        if self.gzipped is not None:
+            response.headers["Vary"] = "Accept-Encoding"
+            if accepts_gzip(request.headers.get("Accept-Encoding")):
+                # a different representation, so it needs its own strong validator
+                body, etag = self.gzipped, self.etag + "-gzip"
+                response.headers["Content-Encoding"] = "gzip"
+        response.set_data(body)
+        response.set_etag(etag)
+        if self.last_modified is not None:
+            response.last_modified = self.last_modified
+        response.headers["Cache-Control"] = self.cache_control
+        return response.make_conditional(request)
+
+
+def content_type_for(path):
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if content_type.startswith("text/"):
+        content_type += "; charset=utf-8"
+    return content_type
+
+
+def load_file(path, cache_control, content_type=None):
+    "Read a file into a StaticAsset, or return None (and log it) if it can't be read"
+    try:
+        with open(path, "rb") as f:
+            body = f.read()
+        last_modified = int(os.path.getmtime(path))
+    except (IOError, OSError) as e:
+        LOG.warning("Not preloading %s: %s", path, e)
+        return None
+    return StaticAsset(body, content_type or content_type_for(path), cache_control, last_modified)
+
+
+def load_directory(root, cache_control):
+    "Read every file under root, returning a dict of StaticAssets keyed by path relative to root"
+    assets = {}
+    for directory, subdirectories, files in os.walk(root):
+        for name in files:
+            path = os.path.join(directory, name)
+            asset = load_file(path, cache_control)
+            if asset is not None:
+                assets[os.path.relpath(path, root).replace(os.sep, "/")] = asset
+    return assets
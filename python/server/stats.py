@@ -0,0 +1,24 @@
+from collections import OrderedDict
+
+# name -> callable returning a JSON-serializable dict (or None if there is nothing to report yet)
+_providers = OrderedDict()
+
+
+def register(name, provider):
+    """
+    Register a source of runtime counters to be reported by the /stats endpoint
+
+    :param name: the key to report the counters under
+    :param provider: a no-arg callable returning a dict of counters, or None
+    """
+    _providers[name] = provider
+
+
+def snapshot():
+    "Collect the current counters from every registered provider"
+    result = OrderedDict()
+    for name, provider in _providers.items():
+        value = provider()
+        if value is not None:
+            result[name] = value
+    return result
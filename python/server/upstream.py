@@ -0,0 +1,84 @@
+import cookielib
+from base64 import b64encode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from server import app
+from server.lazy import PerProcess
+from server.nodes import get_node_pool, hedged
+
+
+class FusionUpstream(object):
+    """
+    Long-lived, pooled HTTP client used by the proxy to talk to Fusion.
+
+    The Authorization header is computed once, and the underlying connection
+    pool keeps sockets warm between requests so that steady-state searches do
+    not pay for a new TCP/TLS handshake.  Requests are spread over the nodes in
+    a NodePool; GETs that can't connect to one node are retried on another.
+    """
+
+    def __init__(self, nodes, username=None, password=None, pool_size=10, keep_alive=True,
+                 connect_timeout=3.05, read_timeout=30):
+        self.nodes = nodes
+        self.timeout = (connect_timeout, read_timeout)
+        self.headers = {}
+        if username is not None and password is not None:
+            user_and_pass = b64encode(username + ":" + password).decode("ascii")
+            self.headers["Authorization"] = "Basic %s" % user_and_pass
+        if not keep_alive:
+            self.headers["Connection"] = "close"
+
+        self.session = requests.Session()
+        # This session is shared by every browser hitting the proxy, so never let
+        # cookies set by Fusion for one user leak into another user's requests
+        self.session.cookies.set_policy(cookielib.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=len(nodes), pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, headers=None, **kwargs):
+        """
+        Issue a request against Fusion
+
+        :param method: the HTTP method
+        :param path: the path (and query string) relative to the Fusion host, e.g. /api/apollo/...
+        :param headers: extra request headers, merged over the default ones
+        :returns: the requests Response
+        """
+        request_headers = dict(self.headers)
+        if headers:
+            request_headers.update(headers)
+        kwargs.setdefault("timeout", self.timeout)
+        return self.nodes.call(lambda node: self.session.request(method, node.url + path, headers=request_headers, **kwargs),
+                               retry=method == "GET", hedge=hedged(method, path), stream=kwargs.get("stream", False))
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def _new_upstream():
+    return FusionUpstream(
+        get_node_pool(),
+        app.config.get("FUSION_APP_USER"),
+        app.config.get("FUSION_APP_PASSWORD"),
+        pool_size=int(app.config.get("FUSION_POOL_SIZE", 10)),
+        keep_alive=app.config.get("FUSION_KEEP_ALIVE", True),
+        connect_timeout=app.config.get("FUSION_CONNECT_TIMEOUT", 3.05),
+        read_timeout=app.config.get("FUSION_READ_TIMEOUT", 30)
+    )
+
+
+_upstream = PerProcess(_new_upstream)
+
+
+def get_upstream():
+    "The pooled Fusion client for this worker process"
+    return _upstream.get()
@@ -1,41 +1,130 @@
+import json
 import logging
 import os
-from flask import render_template, send_from_directory
-from flask import request
-from server import app, backend
+from flask import render_template, send_from_directory, jsonify
+from flask import request, Response, stream_with_context
+from werkzeug.exceptions import NotFound
+from server import app, backend, stats
+from server.signals import accept_signal, client_address, record_signal, tracker_payload
+from server.static import StaticAsset, load_directory, load_file
 
 logging.basicConfig(level=logging.INFO)
 
 LOG = logging.getLogger("views.py")
 
 
+def preload_static_assets():
+    """
+    Load the tracking pixel, the rendered index page and the client templates into memory, so the
+    hottest routes do no file I/O or template rendering.  Everything loaded is immutable, so this is
+    done once at import and shared by every worker.
+    """
+    assets = {}
+    if not app.config.get("STATIC_PRELOAD_ENABLED", False):
+        return assets
+    cache_control = app.config.get("STATIC_CACHE_CONTROL", "public, max-age=3600")
+    pixel = load_file(os.path.join(app.root_path, 'assets/img/onebyone.png'),
+                      app.config.get("STATIC_PIXEL_CACHE_CONTROL", "public, max-age=31536000, immutable"))
+    if pixel is not None:
+        assets["pixel"] = pixel
+    try:
+        with app.app_context():
+            index = render_template('index.html').encode("utf-8")
+        assets["index"] = StaticAsset(index, "text/html; charset=utf-8", cache_control)
+    except Exception as e:
+        LOG.warning("Not preloading index.html: %s", e)
+    for path, asset in load_directory(os.path.join(app.root_path, 'templates'), cache_control).items():
+        assets["templates/" + path] = asset
+    LOG.info("Preloaded %d static assets", len(assets))
+    return assets
+
+
+static_assets = preload_static_assets()
+
+
+def _static_stats():
+    if static_assets:
+        return {"assets": len(static_assets), "bytes": sum(a.size() for a in static_assets.values())}
+
+stats.register("static_assets", _static_stats)
+
+
 @app.route('/')
 def root():
+    if "index" in static_assets:
+        return static_assets["index"].response(request)
     return render_template('index.html')
 
 
 @app.route('/search')
 def search():
+    if "index" in static_assets:
+        return static_assets["index"].response(request)
     return render_template('index.html')
 
 
 # Route all Signals from Snowplow accordingly
 @app.route('/snowplow/<path:path>', methods=["GET", "POST"])
 def track_event(path):
-    # TODO: put in spam prevention
     app_id = request.args.get("aid")
     platform = request.args.get("p")
     event = request.args.get("e")
     timestamp = request.args.get("dtm")
     # print "app: {0} plat: {1} event: {2} time: {3} request: {4}".format(app_id, platform, event, timestamp, request.args)
     if app_id == "searchHub":
-        coll_id = app.config.get("FUSION_COLLECTION", "lucidfind")
-        result = backend.send_signal(coll_id, request.args)
+        payload = tracker_payload(request.args)
+        client = client_address(request.remote_addr, request.headers.getlist("X-Forwarded-For"))
+        if accept_signal(client, payload, request.headers.get("User-Agent")):
+            coll_id = app.config.get("FUSION_COLLECTION", "lucidfind")
+            result = record_signal(coll_id, payload)
     #Snowplow requires you respond with a 1x1 pixel
+    if "pixel" in static_assets:
+        return static_assets["pixel"].response(request)
     return send_from_directory(os.path.join(app.root_path, 'assets/img/'), 'onebyone.png')
 
 
 @app.route('/templates/<path:path>')
 def send_foundation_template(
         path):  # TODO: we shouldn't need this in production since we shouldn't serve static content from Flask
+    asset = static_assets.get("templates/" + path)
+    if asset is not None:
+        return asset.response(request)
     return send_from_directory(os.path.join(app.root_path, 'templates'), path)
+
+
+def ndjson_lines(docs, chunk_size=64 * 1024):
+    "Serialize documents as newline-delimited JSON, in chunks of about chunk_size bytes"
+    chunk = []
+    size = 0
+    for doc in docs:
+        line = json.dumps(doc._asdict(), separators=(",", ":")) + "\n"
+        chunk.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield "".join(chunk)
+
+
+@app.route('/export')
+def export_documents():
+    """
+    Stream every document matching q (and the source, author and project filters) as NDJSON.  Documents are
+    fetched a batch at a time only as fast as the client reads them, so memory use stays flat however many
+    documents match.
+    """
+    if not app.config.get("EXPORT_ENABLED", False):
+        raise NotFound()
+    filters = dict((name, request.args[name]) for name in ("source", "author", "project") if name in request.args)
+    docs = backend.iter_documents(request.args.get("q", "*"), filters,
+                                  app.config.get("EXPORT_BATCH_SIZE", 500))
+    return Response(stream_with_context(ndjson_lines(docs)), mimetype="application/x-ndjson",
+                    headers={"Content-Disposition": "attachment; filename=export.ndjson"})
+
+
+@app.route('/stats')
+def runtime_stats():
+    "Counters from the caches, queues and pools of this worker process"
+    return jsonify(stats.snapshot())
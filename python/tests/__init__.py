@@ -0,0 +1,11 @@
+"""
+Unit tests for the Flask app.  Run them from the python directory with
+
+    python -m unittest discover -s tests -t .
+
+The server package reads its settings from the config module named on the command line as soon as it is
+imported, so point it at tests.config before any test module imports it.
+"""
+import sys
+
+sys.argv = sys.argv[:1] + ["--config", "tests.config"]
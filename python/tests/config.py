@@ -0,0 +1,7 @@
+# Settings for the unit tests: nothing here talks to Fusion
+
+# The base class answers every call without a network round trip
+BACKEND = "server.backends.Backend"
+
+SIGNAL_AGGREGATE_TYPES = ["click", "search"]
+SIGNAL_FILTER_PROXY_HOPS = 1
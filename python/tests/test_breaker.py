@@ -0,0 +1,127 @@
+import unittest
+
+from server.admission import Overloaded
+from server.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen, LastGoodStore
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def fail():
+    raise IOError("connection refused")
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker("/api/search", failure_rate=0.5, slow_seconds=5, window=4, min_calls=4,
+                                      open_seconds=30, clock=self.clock)
+
+    def trip(self):
+        for i in range(4):
+            self.assertRaises(IOError, self.breaker.call, fail)
+
+    def test_stays_closed_below_the_failure_rate(self):
+        self.breaker.call(lambda: 1)
+        self.breaker.call(lambda: 1)
+        self.breaker.call(lambda: 1)
+        self.assertRaises(IOError, self.breaker.call, fail)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_needs_min_calls(self):
+        for i in range(3):
+            self.assertRaises(IOError, self.breaker.call, fail)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_opens(self):
+        self.trip()
+        self.assertEqual(OPEN, self.breaker.state)
+        self.assertRaises(CircuitOpen, self.breaker.call, lambda: 1)
+        self.assertEqual(1, self.breaker.stats()["rejected"])
+        self.assertEqual(1, self.breaker.stats()["opened"])
+
+    def test_is_failure_and_slow_calls(self):
+        self.breaker.call(lambda: 500, is_failure=lambda status: status >= 500)
+
+        def slow():
+            self.clock.now += 6
+            return 200
+        for i in range(3):
+            self.breaker.call(slow)
+        self.assertEqual(OPEN, self.breaker.state)
+
+    def test_half_open_lets_one_probe_through(self):
+        self.trip()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(HALF_OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(True, 0.1)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_failed_probe_opens_again(self):
+        self.trip()
+        self.clock.now += 30
+        self.assertRaises(IOError, self.breaker.call, fail)
+        self.assertEqual(OPEN, self.breaker.state)
+        self.assertEqual(2, self.breaker.stats()["opened"])
+
+    def test_shed_calls_do_not_count(self):
+        def shed():
+            raise Overloaded("/api/search", "queue full")
+        self.trip()
+        self.clock.now += 30
+        self.assertRaises(Overloaded, self.breaker.call, shed)
+        self.assertEqual(HALF_OPEN, self.breaker.state)
+        self.assertEqual(1, self.breaker.call(lambda: 1))
+        self.assertEqual(CLOSED, self.breaker.state)
+
+
+class LastGoodStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.store = LastGoodStore(max_entries=3, max_bytes=100, max_age=60, clock=self.clock)
+
+    def test_get(self):
+        self.store.put("a", 1, 10)
+        self.assertEqual(1, self.store.get("a"))
+        self.assertIsNone(self.store.get("b"))
+        self.assertEqual(1, self.store.stats()["served"])
+
+    def test_max_age(self):
+        self.store.put("a", 1, 10)
+        self.clock.now += 61
+        self.assertIsNone(self.store.get("a"))
+
+    def test_max_entries(self):
+        for key in "abcd":
+            self.store.put(key, key, 10)
+        self.assertIsNone(self.store.get("a"))
+        self.assertEqual("d", self.store.get("d"))
+        self.assertEqual({"entries": 3, "bytes": 30, "served": 1}, self.store.stats())
+
+    def test_max_bytes(self):
+        self.store.put("a", 1, 60)
+        self.store.put("b", 2, 30)
+        self.store.put("c", 3, 30)
+        self.assertIsNone(self.store.get("a"))
+        self.assertEqual(60, self.store.stats()["bytes"])
+
+    def test_too_big_replaces_nothing_but_its_own_key(self):
+        self.store.put("a", 1, 10)
+        self.store.put("b", 2, 10)
+        self.store.put("b", 3, 101)
+        self.assertEqual(1, self.store.get("a"))
+        self.assertIsNone(self.store.get("b"))
+        self.assertEqual(10, self.store.stats()["bytes"])
+
+    def test_put_replaces(self):
+        self.store.put("a", 1, 10)
+        self.store.put("a", 2, 20)
+        self.assertEqual(2, self.store.get("a"))
+        self.assertEqual(20, self.store.stats()["bytes"])
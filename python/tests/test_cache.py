@@ -0,0 +1,126 @@
+import unittest
+
+from server.cache import FRESH, STALE, CachedResponse, ResponseCache, VersionedCache, canonical_key, response_size
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def response(body):
+    return CachedResponse(200, [("Content-Type", "application/json")], body)
+
+
+class CanonicalKeyTest(unittest.TestCase):
+    def test_parameter_order(self):
+        self.assertEqual(canonical_key("/api/search", "q=solr&rows=10"), canonical_key("/api/search", "rows=10&q=solr"))
+
+    def test_variants(self):
+        self.assertNotEqual(canonical_key("/a", "q=1", "gzip"), canonical_key("/a", "q=1", None))
+        self.assertEqual("/a", canonical_key("/a", ""))
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = ResponseCache(1000, ttl_rules={"/api": 10, "/api/signals": 0}, stale_seconds=5, clock=self.clock)
+
+    def test_ttl_rules(self):
+        self.assertEqual(10, self.cache.ttl_for("/api/search"))
+        self.assertEqual(0, self.cache.ttl_for("/api/signals/lucidfind"))
+        self.assertEqual(0, self.cache.ttl_for("/assets/app.js"))
+
+    def test_fresh_stale_and_expired(self):
+        self.cache.put("k", response("body"), 10)
+        self.assertEqual((response("body"), FRESH), self.cache.get("k"))
+        self.clock.now += 10
+        self.assertEqual((response("body"), STALE), self.cache.get("k"))
+        self.clock.now += 5
+        self.assertEqual((None, None), self.cache.get("k"))
+        self.assertEqual(0, self.cache.stats()["bytes"])
+
+    def test_not_cached(self):
+        self.cache.put("k", response("body"), 0)
+        self.cache.put("big", response("x" * 1000), 10)
+        self.assertEqual((None, None), self.cache.get("k"))
+        self.assertEqual((None, None), self.cache.get("big"))
+
+    def test_evicts_least_recently_used(self):
+        body = "x" * 300
+        for key in "abc":
+            self.cache.put(key, response(body), 10)
+        self.cache.get("a")
+        self.cache.put("d", response(body), 10)
+        self.assertEqual((None, None), self.cache.get("b"))
+        self.assertEqual(FRESH, self.cache.get("a")[1])
+        self.assertEqual(1, self.cache.stats()["evictions"])
+        self.assertEqual(3 * response_size("a", response(body)), self.cache.stats()["bytes"])
+
+    def test_one_refresh_at_a_time(self):
+        self.assertTrue(self.cache.start_refresh("k"))
+        self.assertFalse(self.cache.start_refresh("k"))
+        self.cache.end_refresh("k")
+        self.assertTrue(self.cache.start_refresh("k"))
+
+
+class VersionedCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.versions = [1]
+        self.cache = VersionedCache(lambda: self.versions[0], max_entries=2)
+        self.cache.poll()
+
+    def test_put_and_get(self):
+        value, version = self.cache.get("k")
+        self.assertIsNone(value)
+        self.cache.put("k", "v", version)
+        self.assertEqual(("v", 1), self.cache.get("k"))
+
+    def test_new_version_invalidates(self):
+        self.cache.put("k", "v", 1)
+        self.versions[0] = 2
+        self.cache.poll()
+        self.assertEqual((None, 2), self.cache.get("k"))
+        self.cache.put("k", "v", 1)
+        self.assertEqual((None, 2), self.cache.get("k"))
+        self.assertEqual(1, self.cache.stats()["invalidations"])
+
+    def test_unknown_version(self):
+        self.cache.put("k", "v", 1)
+        self.versions[0] = None
+        self.cache.poll()
+        self.assertEqual((None, None), self.cache.get("k"))
+        self.cache.put("k", "v", None)
+        self.assertEqual(1, self.cache.stats()["poll_failures"])
+
+    def test_failing_version_fn(self):
+        def fail():
+            raise IOError("down")
+        self.cache.version_fn = fail
+        self.cache.poll()
+        self.assertIsNone(self.cache.version)
+
+    def test_max_entries(self):
+        for key in "abc":
+            self.cache.put(key, key, 1)
+        self.assertIsNone(self.cache.get("a")[0])
+        self.assertEqual("c", self.cache.get("c")[0])
+
+    def test_monotonic_ignores_older_versions(self):
+        self.cache.monotonic = True
+        self.cache.put("k", "v", 1)
+        self.versions[0] = 0
+        self.cache.poll()
+        self.assertEqual(("v", 1), self.cache.get("k"))
+        self.versions[0] = 2
+        self.cache.poll()
+        self.assertEqual((None, 2), self.cache.get("k"))
+
+    def test_not_monotonic_follows_every_change(self):
+        self.cache.put("k", "v", 1)
+        self.versions[0] = 0
+        self.cache.poll()
+        self.assertEqual((None, 0), self.cache.get("k"))
@@ -0,0 +1,273 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from server import app
+from server.backends import SignalsRejected
+from server.signals import client_address, signal_key
+from server.signals.aggregate import SignalAggregator
+from server.signals.batcher import SignalBatcher
+from server.signals.filter import DEFAULT_BOT_PATTERNS, SignalFilter
+from server.signals.spool import DEAD_LETTERS, SignalSpool
+
+BROWSER = "Mozilla/5.0 (X11; Linux x86_64; rv:45.0) Gecko/20100101 Firefox/45.0"
+
+
+def click(doc_id, query="solr", project="lucene"):
+    data = {"signalType": "click", "docId": doc_id, "query": query, "project": project}
+    return {"e": "ue", "ue_pr": json.dumps({"schema": "iglu:com.lucidworks/click/jsonschema/1-0-0", "data": data})}
+
+
+class Recorder(object):
+    "A send callable that records what it was given and answers with the next of results"
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = []
+
+    def __call__(self, collection_id, payloads):
+        self.calls.append((collection_id, list(payloads)))
+        result = self.results.pop(0) if self.results else True
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class SignalBatcherTest(unittest.TestCase):
+    def test_one_call_per_collection(self):
+        send = Recorder()
+        batcher = SignalBatcher(send)
+        batcher.flush([("a", 1), ("b", 2), ("a", 3)])
+        self.assertEqual([("a", [1, 3]), ("b", [2])], sorted(send.calls))
+        self.assertEqual(2, batcher.stats()["batches"])
+        self.assertEqual(3, batcher.stats()["flushed"])
+
+    def test_failures_are_counted(self):
+        batcher = SignalBatcher(Recorder(False, ValueError("boom")))
+        batcher.flush([("a", 1), ("a", 2)])
+        batcher.flush([("a", 3)])
+        self.assertEqual(3, batcher.stats()["failed"])
+        self.assertEqual(0, batcher.stats()["flushed"])
+
+    def test_offer_drops_when_full(self):
+        batcher = SignalBatcher(Recorder(), max_queue=2)
+        self.assertTrue(batcher.offer("a", 1))
+        self.assertTrue(batcher.offer("a", 2))
+        self.assertFalse(batcher.offer("a", 3))
+        stats = batcher.stats()
+        self.assertEqual((2, 1, 2), (stats["enqueued"], stats["dropped"], stats["queue_depth"]))
+
+    def test_drain(self):
+        send = Recorder()
+        batcher = SignalBatcher(send)
+        batcher.offer("a", 1)
+        batcher.offer("a", 2)
+        batcher.drain()
+        self.assertEqual([("a", [1, 2])], send.calls)
+        self.assertEqual(0, batcher.stats()["queue_depth"])
+
+    def test_next_batch_stops_at_batch_size(self):
+        batcher = SignalBatcher(Recorder(), batch_size=2, flush_interval=10)
+        for i in range(3):
+            batcher.offer("a", i)
+        self.assertEqual([("a", 0), ("a", 1)], batcher._next_batch())
+
+
+class SignalAggregatorTest(unittest.TestCase):
+    def setUp(self):
+        self.emitted = []
+        self.aggregator = SignalAggregator(lambda collection_id, payload: self.emitted.append((collection_id, payload)),
+                                           lambda collection_id, payload: payload.get("key"),
+                                           count_key="_count", max_keys=2)
+
+    def test_counts_repeats(self):
+        for i in range(3):
+            self.assertTrue(self.aggregator.add("a", {"key": 1, "n": i}))
+        self.aggregator.flush()
+        self.assertEqual([("a", {"key": 1, "n": 0, "_count": 3})], self.emitted)
+
+    def test_passes_through_unkeyed_and_overflow(self):
+        self.assertFalse(self.aggregator.add("a", {}))
+        self.assertTrue(self.aggregator.add("a", {"key": 1}))
+        self.assertTrue(self.aggregator.add("a", {"key": 2}))
+        self.assertFalse(self.aggregator.add("a", {"key": 3}))
+        self.assertTrue(self.aggregator.add("a", {"key": 2}))
+        self.assertEqual(2, self.aggregator.stats()["passed_through"])
+
+    def test_flush_starts_a_new_window(self):
+        self.aggregator.add("a", {"key": 1})
+        self.aggregator.flush()
+        self.aggregator.flush()
+        self.assertEqual(1, len(self.emitted))
+        self.assertEqual(0, self.aggregator.stats()["open_keys"])
+
+
+class SignalKeyTest(unittest.TestCase):
+    def test_same_click(self):
+        self.assertEqual(signal_key("c", click("doc-1")), signal_key("c", click("doc-1")))
+        self.assertEqual(("c", "click", "doc-1", "solr", "lucene"), signal_key("c", click("doc-1")))
+
+    def test_different_documents(self):
+        self.assertNotEqual(signal_key("c", click("doc-1")), signal_key("c", click("doc-2")))
+
+    def test_other_types_are_not_aggregated(self):
+        self.assertIsNone(signal_key("c", {"e": "pv"}))
+
+    def test_malformed(self):
+        self.assertIsNone(signal_key("c", {"e": "ue", "ue_px": "a"}))
+        self.assertIsNone(signal_key("c", {"e": "ue", "ue_pr": "{not json"}))
+
+    def test_repeated_parameters_are_hashable(self):
+        payload = {"e": "ue", "signalType": "search", "project": ["lucene", "solr"], "terms": ["a", "b"]}
+        key = signal_key("c", payload)
+        hash(key)
+        self.assertEqual(("c", "search", None, "a b", ("lucene", "solr")), key)
+
+
+class ClientAddressTest(unittest.TestCase):
+    def setUp(self):
+        self.hops = app.config["SIGNAL_FILTER_PROXY_HOPS"]
+
+    def tearDown(self):
+        app.config["SIGNAL_FILTER_PROXY_HOPS"] = self.hops
+
+    def test_no_proxy(self):
+        app.config["SIGNAL_FILTER_PROXY_HOPS"] = 0
+        self.assertEqual("10.0.0.1", client_address("10.0.0.1", ["1.2.3.4"]))
+
+    def test_behind_one_proxy(self):
+        self.assertEqual("1.2.3.4", client_address("10.0.0.1", ["1.2.3.4"]))
+        self.assertEqual("10.0.0.1", client_address("10.0.0.1", []))
+
+    def test_forged_entries_are_ignored(self):
+        self.assertEqual("1.2.3.4", client_address("10.0.0.1", ["6.6.6.6, 1.2.3.4"]))
+        self.assertEqual("1.2.3.4", client_address("10.0.0.1", ["6.6.6.6", "1.2.3.4"]))
+
+    def test_more_hops_than_entries(self):
+        app.config["SIGNAL_FILTER_PROXY_HOPS"] = 3
+        self.assertEqual("1.2.3.4", client_address("10.0.0.1", ["1.2.3.4, 10.0.0.2"]))
+
+
+class SignalFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.filter = SignalFilter(rate_limit=2, bot_patterns=DEFAULT_BOT_PATTERNS)
+
+    def test_bots(self):
+        self.assertEqual("bot", self.filter.check("1.2.3.4", "e1", "Googlebot/2.1"))
+        self.assertEqual("bot", self.filter.check("1.2.3.4", "e2", None))
+        self.assertIsNone(self.filter.check("1.2.3.4", "e3", BROWSER))
+
+    def test_duplicates(self):
+        self.assertIsNone(self.filter.check("1.2.3.4", "e1", BROWSER))
+        self.assertEqual("duplicate", self.filter.check("5.6.7.8", "e1", BROWSER))
+        self.assertIsNone(self.filter.check("5.6.7.8", None, BROWSER))
+        self.assertIsNone(self.filter.check("5.6.7.8", None, BROWSER))
+
+    def test_duplicates_across_a_rotation(self):
+        self.filter.check("1.2.3.4", "e1", BROWSER)
+        self.filter.seen.rotate()
+        self.assertEqual("duplicate", self.filter.check("5.6.7.8", "e1", BROWSER))
+        self.filter.seen.rotate()
+        self.assertIsNone(self.filter.check("5.6.7.8", "e1", BROWSER))
+
+    def test_rate_limit(self):
+        self.assertIsNone(self.filter.check("1.2.3.4", "e1", BROWSER))
+        self.assertIsNone(self.filter.check("1.2.3.4", "e2", BROWSER))
+        self.assertEqual("rate_limited", self.filter.check("1.2.3.4", "e3", BROWSER))
+        self.assertIsNone(self.filter.check("5.6.7.8", "e4", BROWSER))
+
+    def test_rate_limited_events_are_not_marked_seen(self):
+        self.filter.check("1.2.3.4", "e1", BROWSER)
+        self.filter.check("1.2.3.4", "e2", BROWSER)
+        self.assertEqual("rate_limited", self.filter.check("1.2.3.4", "e3", BROWSER))
+        # the retry comes through a different address, or after the window
+        self.assertIsNone(self.filter.check("5.6.7.8", "e3", BROWSER))
+
+    def test_stats(self):
+        self.filter.check("1.2.3.4", "e1", BROWSER)
+        self.filter.check("1.2.3.4", "e1", BROWSER)
+        self.filter.check("1.2.3.4", "e2", "curl/7.47.0")
+        stats = self.filter.stats()
+        self.assertEqual((1, 1, 1, 0), (stats["accepted"], stats["dropped_duplicate"], stats["dropped_bot"],
+                                        stats["dropped_rate_limited"]))
+
+
+class SignalSpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.send = Recorder()
+        self.spool = SignalSpool(self.root, self.send, fsync="never", batch_size=10)
+
+    def tearDown(self):
+        self.spool.own.close()
+        for spool_dir in self.spool.adopted:
+            spool_dir.close()
+        shutil.rmtree(self.root)
+
+    def dead_letters(self):
+        with open(os.path.join(self.root, DEAD_LETTERS)) as f:
+            return [json.loads(line)["p"] for line in f]
+
+    def test_replay(self):
+        self.spool.append("a", {"n": 1})
+        self.spool.append("a", {"n": 2})
+        self.assertTrue(self.spool.replay_once())
+        self.assertEqual([("a", [{"n": 1}, {"n": 2}])], self.send.calls)
+        self.assertFalse(self.spool.replay_once())
+        self.assertEqual(2, self.spool.stats()["replayed"])
+
+    def test_one_call_per_run_of_a_collection(self):
+        for collection_id, n in [("a", 1), ("a", 2), ("b", 3), ("a", 4)]:
+            self.spool.append(collection_id, {"n": n})
+        self.spool.replay_once()
+        self.assertEqual([("a", [{"n": 1}, {"n": 2}]), ("b", [{"n": 3}]), ("a", [{"n": 4}])], self.send.calls)
+
+    def test_failure_is_retried(self):
+        self.send.results = [False]
+        self.spool.append("a", {"n": 1})
+        self.assertIsNone(self.spool.replay_once())
+        self.assertTrue(self.spool.replay_once())
+        self.assertEqual([("a", [{"n": 1}])] * 2, self.send.calls)
+        self.assertEqual(1, self.spool.stats()["failures"])
+
+    def test_progress_is_kept_per_collection(self):
+        # "a" goes through, then sending "b" fails: only "b" is sent again
+        self.send.results = [True, ValueError("down")]
+        self.spool.append("a", {"n": 1})
+        self.spool.append("b", {"n": 2})
+        self.assertIsNone(self.spool.replay_once())
+        self.assertTrue(self.spool.replay_once())
+        self.assertEqual([("a", [{"n": 1}]), ("b", [{"n": 2}]), ("b", [{"n": 2}])], self.send.calls)
+
+    def test_rejected_record_is_dead_lettered(self):
+        accepted = []
+
+        def send(collection_id, payloads):
+            if {"n": "bad"} in payloads:
+                raise SignalsRejected("invalid")
+            accepted.extend(payloads)
+            return True
+        self.spool.send = send
+        for n in [1, "bad", 3, 4]:
+            self.spool.append("a", {"n": n})
+        self.assertTrue(self.spool.replay_once())
+        self.assertEqual([{"n": 1}, {"n": 3}, {"n": 4}], accepted)
+        self.assertEqual([{"n": "bad"}], self.dead_letters())
+        self.assertEqual(1, self.spool.stats()["dead_lettered"])
+        self.assertEqual(3, self.spool.stats()["replayed"])
+        self.assertFalse(self.spool.replay_once())
+
+    def test_adopts_orphaned_directories(self):
+        # what a process that died left behind
+        dead = os.path.join(self.root, "12345")
+        os.makedirs(dead)
+        with open(os.path.join(dead, "%020d.log" % 1), "w") as f:
+            f.write(json.dumps({"c": "a", "p": {"n": 1}, "t": 0}) + "\n")
+        self.spool.adopt_orphans()
+        self.assertEqual(1, self.spool.stats()["adopted_directories"])
+        self.assertTrue(self.spool.replay_once())
+        self.assertEqual([("a", [{"n": 1}])], self.send.calls)
+        self.spool.replay_once()
+        self.assertFalse(os.path.exists(dead))
@@ -0,0 +1,100 @@
+import threading
+import time
+import unittest
+
+from server.singleflight import SingleFlight
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.flight = SingleFlight(wait_timeout=5.0, is_failure=lambda result: result == "bad")
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def leader(self, result):
+        "A call that blocks, once it has started, until release is set"
+        def fn():
+            self.calls += 1
+            self.started.set()
+            self.release.wait(5)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return fn
+
+    def follower(self, results):
+        def fn():
+            self.calls += 1
+            return "own"
+        thread = threading.Thread(target=lambda: results.append(self.flight.do("k", fn)))
+        thread.start()
+        return thread
+
+    def run_leader(self, result, results):
+        def run():
+            try:
+                results.append(self.flight.do("k", self.leader(result)))
+            except Exception as e:
+                results.append(e)
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.assertTrue(self.started.wait(5))
+        return thread
+
+    def wait_for_waiters(self):
+        "Give the follower threads time to find the leader's call and start waiting on it"
+        time.sleep(0.1)
+
+    def test_shares_the_leaders_result(self):
+        leader_results, results = [], []
+        leader = self.run_leader("result", leader_results)
+        followers = [self.follower(results) for i in range(3)]
+        self.wait_for_waiters()
+        self.release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+        self.assertEqual(["result"], leader_results)
+        self.assertEqual(["result"] * 3, results)
+        self.assertEqual(1, self.calls)
+        self.assertEqual(3, self.flight.stats()["shared"])
+
+    def test_falls_back_when_the_leader_fails(self):
+        leader_results, results = [], []
+        leader = self.run_leader(IOError("down"), leader_results)
+        follower = self.follower(results)
+        self.wait_for_waiters()
+        self.release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertIsInstance(leader_results[0], IOError)
+        self.assertEqual(["own"], results)
+        self.assertEqual(1, self.flight.stats()["fallbacks"])
+
+    def test_falls_back_on_a_bad_result(self):
+        leader_results, results = [], []
+        leader = self.run_leader("bad", leader_results)
+        follower = self.follower(results)
+        self.wait_for_waiters()
+        self.release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(["bad"], leader_results)
+        self.assertEqual(["own"], results)
+
+    def test_falls_back_when_the_leader_is_slow(self):
+        self.flight.wait_timeout = 0.05
+        leader_results, results = [], []
+        leader = self.run_leader("result", leader_results)
+        follower = self.follower(results)
+        follower.join(5)
+        self.release.set()
+        leader.join(5)
+        self.assertEqual(["own"], results)
+        self.assertEqual(1, self.flight.stats()["timeouts"])
+
+    def test_sequential_calls_run_again(self):
+        self.assertEqual(1, self.flight.do("k", lambda: 1))
+        self.assertEqual(2, self.flight.do("k", lambda: 2))
+        self.assertEqual({"in_flight": 0, "leaders": 2, "shared": 0, "timeouts": 0, "fallbacks": 0},
+                         self.flight.stats())
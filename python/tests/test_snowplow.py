@@ -0,0 +1,131 @@
+import base64
+import json
+import unittest
+
+from server.backends import SignalsRejected
+from server.backends.fusion import (FusionBackend, SIGNAL_COUNT_KEY, _snowplow_json, snowplow_to_signal,
+                                    tracker_param)
+
+
+def encode(value):
+    "What the Snowplow tracker sends for a JSON parameter with base64 encoding on: unpadded urlsafe base64"
+    return base64.urlsafe_b64encode(json.dumps(value)).rstrip("=")
+
+
+CLICK = {
+    "schema": "iglu:com.snowplowanalytics.snowplow/unstruct_event/jsonschema/1-0-0",
+    "data": {
+        "schema": "iglu:com.lucidworks/click/jsonschema/1-0-0",
+        "data": {"signalType": "click", "docId": "doc-1", "query": "solr"}
+    }
+}
+
+CONTEXTS = {
+    "schema": "iglu:com.snowplowanalytics.snowplow/contexts/jsonschema/1-0-0",
+    "data": [{"schema": "iglu:com.lucidworks/project/jsonschema/1-0-0", "data": {"project": "lucene"}}]
+}
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, text=""):
+        self.status_code = status_code
+        self.text = text
+
+
+class FakeSession(object):
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+        self.posted = []
+
+    def post(self, path, data=None, headers=None):
+        self.posted.append((path, json.loads(data)))
+        return FakeResponse(self.status_code, "rejected")
+
+
+def fake_backend(status_code=200):
+    "A FusionBackend that posts to a FakeSession instead of logging in to Fusion"
+    backend = FusionBackend.__new__(FusionBackend)
+    backend.admin_session = FakeSession(status_code)
+    return backend
+
+
+class TrackerParamTest(unittest.TestCase):
+    def test_single_value(self):
+        self.assertEqual("pv", tracker_param({"e": "pv"}, "e"))
+
+    def test_first_of_repeated_values(self):
+        self.assertEqual("pv", tracker_param({"e": ["pv", "ue"]}, "e"))
+
+    def test_default(self):
+        self.assertEqual("x", tracker_param({}, "e", "x"))
+        self.assertEqual("x", tracker_param({"e": []}, "e", "x"))
+
+
+class SnowplowJsonTest(unittest.TestCase):
+    def test_plain(self):
+        self.assertEqual(CLICK, _snowplow_json({"ue_pr": json.dumps(CLICK)}, "ue_pr", "ue_px"))
+
+    def test_encoded(self):
+        self.assertEqual(CLICK, _snowplow_json({"ue_px": encode(CLICK)}, "ue_pr", "ue_px"))
+
+    def test_missing(self):
+        self.assertIsNone(_snowplow_json({}, "ue_pr", "ue_px"))
+
+    def test_bad_base64(self):
+        self.assertIsNone(_snowplow_json({"ue_px": "a"}, "ue_pr", "ue_px"))
+
+    def test_bad_json(self):
+        self.assertIsNone(_snowplow_json({"ue_pr": "{not json"}, "ue_pr", "ue_px"))
+        self.assertIsNone(_snowplow_json({"ue_px": encode(CLICK)[:-8]}, "ue_pr", "ue_px"))
+
+    def test_repeated_parameter(self):
+        self.assertEqual(CLICK, _snowplow_json({"ue_px": [encode(CLICK), "a"]}, "ue_pr", "ue_px"))
+
+
+class SnowplowToSignalTest(unittest.TestCase):
+    def test_unstructured_event_and_contexts(self):
+        signal = snowplow_to_signal({"e": "ue", "ue_px": encode(CLICK), "cx": encode(CONTEXTS), "dtm": "1450000000000"})
+        self.assertEqual("click", signal["type"])
+        self.assertEqual(1450000000000, signal["timestamp"])
+        self.assertEqual("doc-1", signal["params"]["docId"])
+        self.assertEqual("lucene", signal["params"]["project"])
+        self.assertNotIn("ue_px", signal["params"])
+        self.assertNotIn("cx", signal["params"])
+        self.assertNotIn("count", signal)
+
+    def test_event_type_without_unstructured_event(self):
+        signal = snowplow_to_signal({"e": ["pv", "pv"], "url": "http://example.com/"})
+        self.assertEqual("pv", signal["type"])
+        self.assertNotIn("timestamp", signal)
+
+    def test_count(self):
+        signal = snowplow_to_signal({"e": "ue", "ue_pr": json.dumps(CLICK), SIGNAL_COUNT_KEY: 3})
+        self.assertEqual(3, signal["count"])
+        self.assertNotIn(SIGNAL_COUNT_KEY, signal["params"])
+
+    def test_malformed(self):
+        self.assertIsNone(snowplow_to_signal({"e": "ue", "ue_px": "a"}))
+        self.assertIsNone(snowplow_to_signal({"e": "ue", "ue_pr": "{not json"}))
+        self.assertIsNone(snowplow_to_signal({"e": "ue", "ue_pr": json.dumps(CLICK), "cx": "%%%"}))
+
+
+class SendSignalsTest(unittest.TestCase):
+    def test_drops_malformed(self):
+        backend = fake_backend()
+        good = {"e": "ue", "ue_px": encode(CLICK)}
+        self.assertTrue(backend.send_signals("lucidfind", [good, {"e": "ue", "ue_px": "a"}]))
+        [(path, signals)] = backend.admin_session.posted
+        self.assertEqual("apollo/signals/lucidfind", path)
+        self.assertEqual([snowplow_to_signal(good)], signals)
+
+    def test_nothing_left(self):
+        backend = fake_backend()
+        self.assertTrue(backend.send_signals("lucidfind", [{"ue_px": "a"}]))
+        self.assertEqual([], backend.admin_session.posted)
+
+    def test_rejected(self):
+        self.assertRaises(SignalsRejected, fake_backend(400).send_signals, "lucidfind", [{"e": "pv"}])
+
+    def test_failed(self):
+        self.assertFalse(fake_backend(503).send_signals("lucidfind", [{"e": "pv"}]))
+        self.assertFalse(fake_backend(429).send_signals("lucidfind", [{"e": "pv"}]))